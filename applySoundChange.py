@@ -0,0 +1,148 @@
+# -*- encoding: utf-8 -*-
+###
+# Stream a text file through a .soundchange file, line by line
+#  usage: python applySoundChange.py [options] rules.soundchange [input|-] [output|-]
+#  input and output default to stdin and stdout; progress goes to stderr
+"""
+Lines are read, sound changed and written a batch at a time, so memory stays
+bounded however big the input is: a few batches in flight, plus the word memo
+(see soundChange.APPLY_MEMO_SIZE). With --workers, batches go out to a pool of
+processes and come back in order. A line that fails to parse is passed
+through unchanged and reported on stderr with its line number; anything the
+sound change code prints goes to stderr too, so stdout is only ever output.
+
+--corpus treats each line as a .corpus entry ("text = gloss = ..."), changing
+only the text, as Language.FromSoundChange does.
+"""
+import collections
+import optparse
+import sys
+import time
+
+import soundChange
+
+BATCH_SIZE = 1000 # lines per batch, and per task with --workers
+PROGRESS_INTERVAL = 2.0 # seconds between progress lines
+
+def CorpusText(line):
+    """(text to sound change, chunks kept as they are) for a .corpus line, see languageFamily.ParseCorpusFile"""
+    chunks = [chunk.strip() for chunk in line.strip().split(u"=")]
+    return chunks[0], chunks[1:]
+
+def ChangeLines(sc, lines):
+    """(sc.ApplyToLines(lines), [(index, error)]), with each line that fails passed through unchanged"""
+    try:
+        return sc.ApplyToLines(lines), []
+    except Exception:
+        pass
+    changed, failures = [], []
+    for (ii, line) in enumerate(lines):
+        try:
+            changed.append(sc.ApplyToLines([line])[0])
+        except Exception as e:
+            changed.append(line)
+            failures.append((ii, str(e)))
+    return changed, failures
+
+def ChangeChunk(lines):
+    return ChangeLines(soundChange.WORKER_SOUND_CHANGE, lines)
+
+def ReadBatches(inFile, batchSize, progress):
+    batch = []
+    for raw in inFile:
+        progress.Read(len(raw))
+        batch.append(raw.decode("utf-8").rstrip(u"\r\n"))
+        if len(batch) >= batchSize:
+            yield batch
+            batch = []
+    if len(batch) > 0: yield batch
+
+class Progress:
+    def __init__(self, out, totalBytes=None, interval=PROGRESS_INTERVAL):
+        self.Out = out
+        self.TotalBytes = totalBytes
+        self.Interval = interval
+        self.BytesRead = 0
+        self.LinesWritten = 0
+        self.Start = time.time()
+        self.LastReport = self.Start
+    def Read(self, byteCount):
+        self.BytesRead += byteCount
+    def Wrote(self, lineCount):
+        self.LinesWritten += lineCount
+        now = time.time()
+        if self.Out != None and now - self.LastReport >= self.Interval:
+            self.LastReport = now
+            self.Report(now)
+    def Report(self, now=None, end="\r"):
+        if self.Out == None: return
+        if now == None: now = time.time()
+        elapsed = max(now - self.Start, 1e-6)
+        line = "%d lines, %.1f MB, %.0f lines/s, %.2f MB/s" % (self.LinesWritten, self.BytesRead / 1e6, self.LinesWritten / elapsed, self.BytesRead / 1e6 / elapsed)
+        if self.TotalBytes: line += ", %.1f%%" % (100.0 * self.BytesRead / self.TotalBytes)
+        self.Out.write(line + end)
+        self.Out.flush()
+
+def ChangeBatches(sc, batches, corpus=False, workers=1):
+    """(sound changed lines, failures) for each batch, in order, see ChangeLines
+    workers other than 1 uses a process pool (None for one per CPU)"""
+    if corpus: batches = ([CorpusText(line) for line in batch] for batch in batches)
+    else: batches = ([(line, []) for line in batch] for batch in batches)
+    def Finish(parts, result):
+        changed, failures = result
+        return [u" = ".join([text] + rest) for (text, (original, rest)) in zip(changed, parts)], failures
+    def Texts(parts):
+        return [text for (text, rest) in parts]
+    if workers == 1:
+        for parts in batches:
+            yield Finish(parts, ChangeLines(sc, Texts(parts)))
+        return
+    import multiprocessing
+    pool = multiprocessing.Pool(workers, soundChange.StartWorker, (sc.OrigRules(), sc.SpecialNames))
+    window = (workers or multiprocessing.cpu_count()) * 2
+    pending = collections.deque()
+    try:
+        for parts in batches:
+            pending.append((parts, pool.apply_async(ChangeChunk, (Texts(parts),))))
+            if len(pending) >= window:
+                parts, result = pending.popleft()
+                yield Finish(parts, result.get())
+        while len(pending) > 0:
+            parts, result = pending.popleft()
+            yield Finish(parts, result.get())
+    finally:
+        pool.terminate()
+
+def Run(rulesPath, inFile, outFile, corpus=False, workers=1, batchSize=BATCH_SIZE, progress=None, errors=None):
+    """Sound change inFile to outFile; failed lines are reported to errors (default stderr)"""
+    sc = soundChange.SoundChange.FromSoundChangeList(soundChange.GetSoundChanges(rulesPath))
+    if progress == None: progress = Progress(None)
+    if errors == None: errors = sys.stderr
+    for (changed, failures) in ChangeBatches(sc, ReadBatches(inFile, batchSize, progress), corpus, workers):
+        for (ii, error) in failures:
+            errors.write("line %d: %s, passed through unchanged\n" % (progress.LinesWritten + ii + 1, error))
+        outFile.write(u"".join([line + u"\n" for line in changed]).encode("utf-8"))
+        outFile.flush()
+        progress.Wrote(len(changed))
+    return progress
+
+if __name__ == '__main__':
+    import os
+    parser = optparse.OptionParser(usage="%prog [options] rules.soundchange [input|-] [output|-]")
+    parser.add_option("-c", "--corpus", action="store_true", default=False, help="lines are .corpus entries, change only the text before the first '='")
+    parser.add_option("-w", "--workers", type="int", default=1, help="worker processes, 0 for one per CPU (default 1, no pool)")
+    parser.add_option("-b", "--batch", type="int", default=BATCH_SIZE, help="lines per batch (default %default)")
+    parser.add_option("-q", "--quiet", action="store_true", default=False, help="no progress on stderr")
+    options, args = parser.parse_args()
+    soundChange.ipaParse.SaveTables() # so the next run only reads the table cache
+    if not(1 <= len(args) <= 3): parser.error("expected a .soundchange file, then optionally input and output paths")
+    inPath = args[1] if len(args) > 1 else "-"
+    outPath = args[2] if len(args) > 2 else "-"
+    inFile = sys.stdin if inPath == "-" else open(inPath, "rb")
+    outFile = sys.stdout if outPath == "-" else open(outPath, "wb")
+    sys.stdout = sys.stderr # DoReplacement prints parse failures; keep them out of the output (and the workers inherit this)
+    totalBytes = os.path.getsize(inPath) if inPath != "-" else None
+    progress = Progress(None if options.quiet else sys.stderr, totalBytes)
+    Run(args[0], inFile, outFile, options.corpus, options.workers or None, max(options.batch, 1), progress)
+    progress.Report(end="\n")
+    outFile.close()
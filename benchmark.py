@@ -0,0 +1,246 @@
+# -*- encoding: utf-8 -*-
+###
+# Timing for the hot paths
+#  usage: python benchmark.py [name ...]
+#  with no names, runs everything in BENCHMARKS
+
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+REPEAT = 5
+
+def BestOf(f, repeat=REPEAT):
+    best = None
+    for ii in range(repeat):
+        start = time.time()
+        f()
+        elapsed = time.time() - start
+        if best == None or elapsed < best: best = elapsed
+    return best
+
+def Report(name, seconds, baseline=None):
+    line = "  %-40s %9.2f ms" % (name, seconds * 1000)
+    if baseline != None and seconds > 0: line += "  (%.1fx)" % (baseline / seconds)
+    print line
+
+def ImportTime(env):
+    """Seconds spent importing ipaParse in a fresh interpreter"""
+    code = "import time; t = time.time(); import ipaParse; print time.time() - t"
+    here = os.path.dirname(os.path.abspath(__file__))
+    out = subprocess.check_output([sys.executable, "-c", code], env=env, cwd=here)
+    return float(out.strip())
+
+def BenchImport():
+    print "import ipaParse (best of", REPEAT, "fresh interpreters)"
+    cachePath = os.path.join(tempfile.mkdtemp(), "ipaParse.tables")
+    uncached = dict(os.environ, IPAPARSE_TABLE_CACHE="")
+    cached = dict(os.environ, IPAPARSE_TABLE_CACHE=cachePath)
+    here = os.path.dirname(os.path.abspath(__file__))
+    subprocess.check_call([sys.executable, "-c", "import ipaParse; ipaParse.SaveTables()"], env=cached, cwd=here) # importing alone never writes it
+    baseline = min([ImportTime(uncached) for ii in range(REPEAT)])
+    Report("tables rebuilt (no cache)", baseline)
+    Report("tables from cache", min([ImportTime(cached) for ii in range(REPEAT)]), baseline)
+    os.remove(cachePath)
+
+RULES = [u'b > p /', u's > /#_', u'se > e /', u's > /{vowel}_', u's > /_{vowel}', u's > /{vowel}_{vowel}', u'[sz] > t /']
+CASCADE = RULES + [u's > /_#', u'm̥ > m /', u'[ou] > u /_#'] # a longer cascade, for the whole-cascade benchmarks
+WORD_GRAPHEMES = [u'a', u'b', u'e', u'i', u'k', u'm̥', u'o', u's', u't', u'u', u'z', u'ʃ']
+
+def Words(count, length, seed=0):
+    r = random.Random(seed)
+    return [u''.join([r.choice(WORD_GRAPHEMES) for ii in range(length)]) for jj in range(count)]
+
+def Cascade(rules=CASCADE):
+    """A fresh SoundChange of rules, so no memo carries over between runs"""
+    import ipaParse
+    import soundChange
+    return soundChange.SoundChange(rules, {"vowel": ipaParse.ALL_VOWELS})
+
+def Say(text):
+    """print for text that may hold non-ASCII rules, even when stdout is a pipe"""
+    print text.encode("utf-8") if isinstance(text, unicode) else text
+
+def Compare(title, runs, repeat=REPEAT):
+    """Time each (label, f) in runs, best of repeat, the first being the baseline the others are measured against"""
+    print title, "(best of", repeat, "runs)"
+    baseline = None
+    for (label, f) in runs:
+        seconds = BestOf(f, repeat)
+        Report(label, seconds, baseline)
+        if baseline == None: baseline = seconds
+
+def BenchRules():
+    import ipaParse
+    sc = Cascade(RULES)
+    words = Words(2000, 8)
+    for (rule, path, reason) in sc.ParserPaths():
+        Say(u"    %-24s %s" % (rule, path))
+    def interpreted():
+        ipaParse.COMPILE_TO_REGEX = False
+        try: [sc.Apply(w) for w in words]
+        finally: ipaParse.COMPILE_TO_REGEX = True
+    Compare("apply %d rules to 2000 words" % len(RULES), [
+        ("interpreter", interpreted),
+        ("compiled where possible", lambda: [sc.Apply(w) for w in words])])
+
+def BenchEndOfWord():
+    print "apply 's > /_#' to words with no final s; time per grapheme should not grow with length"
+    sc = Cascade([u's > /_#'])
+    for length in [10, 100, 1000]:
+        words = [w.replace(u's', u'a') for w in Words(20000 / length, length)]
+        seconds = BestOf(lambda: [sc.Apply(w) for w in words])
+        Report("%4d-grapheme words, per 1000 graphemes" % length, seconds / 20)
+
+def BenchCascade():
+    sc = Cascade()
+    words = Words(2000, 8)
+    Compare("final form after %d rules, 2000 words" % len(CASCADE), [
+        ("rule by rule (Apply)", lambda: [sc.Apply(w)[-1] for w in words]),
+        ("composed transducer (Transduce)", lambda: [sc.Transduce(w) for w in words])])
+
+def BenchRuleLoad():
+    import soundChange
+    rules = [u'%s > %s /%s' % (f, t, c) for f in [u's', u'b', u'se', u'[sz]', u'm̥'] for t in [u'', u'p'] for c in [u'', u'_#', u'#_', u'{vowel}_', u'_{vowel}']]
+    def load(): return [Cascade([rule]) for rule in rules]
+    def cold():
+        soundChange.RULE_CACHE.Clear()
+        load()
+    Compare("build a SoundChange per rule for %d rules, as GetSoundChanges does" % len(rules), [
+        ("empty rule cache", cold),
+        ("second load, from the rule cache", load)])
+
+def BenchApplyMany():
+    r = random.Random(0)
+    distinct = Words(500, 8)
+    words = [r.choice(distinct) for ii in range(20000)]
+    warm = Cascade()
+    warm.ApplyMany(words)
+    Compare("final form of 20000 words drawn from 500 distinct ones", [
+        ("one word at a time (Transduce)", lambda: [sc.Transduce(w) for sc in [Cascade()] for w in words]),
+        ("deduplicated (ApplyMany)", lambda: Cascade().ApplyMany(words)),
+        ("again, from the memo", lambda: warm.ApplyMany(words))])
+
+def BenchParallel():
+    import multiprocessing
+    words = Words(20000, 8)
+    workers = multiprocessing.cpu_count()
+    sc = Cascade()
+    pool = sc.StartPool(workers)
+    # new words each run, since the workers keep their memos between calls
+    seeds = iter(range(1, 4))
+    try:
+        Compare("final form of 20000 distinct words, serial and over %d processes" % workers, [
+            ("serial (ApplyMany)", lambda: Cascade().ApplyMany(words)),
+            ("%d workers (ApplyParallel)" % workers, lambda: Cascade().ApplyParallel(words, workers)),
+            ("%d workers, pool already started" % workers, lambda: sc.ApplyParallel(Words(20000, 8, next(seeds)), workers, pool=pool))], 3)
+    finally:
+        pool.terminate()
+    if workers == 1: print "    only one CPU here, so the pool can only add overhead"
+
+def BenchHistory():
+    rules = CASCADE + [u'a > e /', u'ʃ > s /']
+    sc = Cascade(rules)
+    words = Words(2000, 8)
+    Compare("every stage vs only the changes, %d rules, 2000 words" % len(rules), [
+        ("every stage (Apply)", lambda: [sc.Apply(w) for w in words]),
+        ("current form only (ApplyFinal)", lambda: [sc.ApplyFinal(w) for w in words]),
+        ("changed stages (History)", lambda: [sc.History(w) for w in words])])
+    print "    forms kept: %d by Apply, %d by History" % (sum([len(sc.Apply(w)) for w in words]), sum([len(sc.History(w)) for w in words]))
+
+def InventoryGraphemes():
+    import ipaParse
+    return sorted(ipaParse.ALL_CONSONANTS)[0:40] + sorted(ipaParse.ALL_VOWELS)[0:10]
+
+def BenchIndexed():
+    import soundChange
+    r = random.Random(0)
+    graphemes = InventoryGraphemes()
+    rules = [u'%s > %s /%s' % (r.choice(graphemes), r.choice(graphemes), r.choice([u'', u'_#', u'#_', u'{vowel}_', u'_{vowel}'])) for ii in range(50)]
+    words = list(set([u''.join([r.choice(graphemes) for ii in range(r.randint(3, 10))]) for jj in range(5000)]))
+    sc = Cascade(rules)
+    Compare("final form of %d words over %d graphemes after 50 rules" % (len(words), len(graphemes)), [
+        ("every rule on every word (Apply)", lambda: [sc.Apply(w)[-1] for w in words]),
+        ("candidate words only (WordIndex)", lambda: soundChange.IndexedForms(sc, words)),
+        ("composed transducer (Transduce)", lambda: [sc.Transduce(w) for w in words])], 3)
+
+def BenchClasses():
+    import ipaParse
+    import soundChange
+    places = ['bilabial', 'alveolar', 'palatal', 'velar', 'uvular']
+    manners = ['plosive', 'fricative', 'nasal']
+    rules = [u'{%s %s} > {%s} /%s' % (place, manner, other, condition) for place in places for manner in manners for other in manners if other != manner for condition in [u'', u'_#', u'{voiced}_']]
+    def load(): return [Cascade([rule]) for rule in rules]
+    def cold():
+        soundChange.RULE_CACHE.Clear()
+        ipaParse.FEATURES = None
+        load()
+    Compare("build %d feature-class rules, one SoundChange each" % len(rules), [("empty rule and feature caches", cold)])
+    sc = soundChange.SoundChange.FromSoundChangeList(load())
+    words = Words(200, 8)
+    Compare("apply them", [("%d rules over 200 words (ApplyFinal)" % len(rules), lambda: [sc.ApplyFinal(w) for w in words])])
+
+def BenchSkip():
+    r = random.Random(0)
+    graphemes = InventoryGraphemes()
+    brackets = [u''.join(r.sample(graphemes, 12)) for ii in range(20)]
+    rules = [u'[%s] > %s /%s' % (bracket, r.choice(graphemes), r.choice([u'', u'_#', u'#_', u'{vowel}_'])) for bracket in brackets]
+    rules += [u'%s%s > %s /' % (r.choice(graphemes), r.choice(graphemes), r.choice(graphemes)) for ii in range(20)]
+    lines = [u' '.join(Words(6, 6, seed)) for seed in range(300)]
+    # one-grapheme and two-grapheme rules over the whole inventory, on dictionary words: most rules can't fire on most words
+    sparse = [u'%s > %s /%s' % (g, r.choice(graphemes), r.choice([u'', u'_#', u'{vowel}_'])) for g in graphemes]
+    sparse += [u'%s%s > %s /' % (r.choice(graphemes), r.choice(graphemes), r.choice(graphemes)) for ii in range(30)]
+    words = [u''.join([r.choice(graphemes) for ii in range(r.randint(3, 8))]) for jj in range(2000)]
+    for (title, rules, texts) in [("40 bracket and two-grapheme rules over 300 six-word lines", rules, lines),
+                                  ("%d one- and two-grapheme rules over 2000 words" % len(sparse), sparse, words)]:
+        sc = Cascade(rules)
+        Compare(title, [
+            ("every rule on every text", lambda: [sc.RunPasses(w, sc.Compiled, skip=False) for w in texts]),
+            ("skip if no first grapheme", lambda: [sc.RunPasses(w, sc.Compiled) for w in texts])], 3)
+        stats = sc.EnableStats()
+        for text in texts: sc.ApplyFinal(text)
+        sc.DisableStats()
+        skipped = sum([s.Skipped for s in stats.Rules])
+        print "    %.0f%% of rule applications skipped" % (100.0 * skipped / (skipped + sum([s.Attempted for s in stats.Rules])))
+
+def BenchCorpus():
+    r = random.Random(0)
+    distinct = Words(300, 6)
+    lines = [u' '.join([r.choice(distinct) for ii in range(8)]) for jj in range(2000)]
+    Compare("final form of 2000 eight-word corpus lines drawn from 300 words", [
+        ("whole lines (ApplyMany)", lambda: Cascade().ApplyMany(lines)),
+        ("word by word (ApplyToLines)", lambda: Cascade().ApplyToLines(lines))], 3)
+
+def BenchFusion():
+    rules = [u'b > p /', u'd > t /', u'g > k /', u'z > s /', u'm̥ > m /', u'o > u /', u'ʃ > s /', u'i > e /', u's > /_#', u'e > i /', u'u > o /', u'k > /']
+    sc = Cascade(rules)
+    words = Words(2000, 8)
+    Say(u"    " + sc.FusionReport().replace(u"\n", u"\n    "))
+    Compare("final form after %d rules, 2000 words" % len(rules), [
+        ("a pass per rule", lambda: [sc.RunPasses(w, sc.Compiled) for w in words]),
+        ("fused passes (ApplyFinal)", lambda: [sc.ApplyFinal(w) for w in words])])
+
+BENCHMARKS = [
+    ("import", BenchImport),
+    ("rules", BenchRules),
+    ("endofword", BenchEndOfWord),
+    ("cascade", BenchCascade),
+    ("ruleload", BenchRuleLoad),
+    ("applymany", BenchApplyMany),
+    ("parallel", BenchParallel),
+    ("history", BenchHistory),
+    ("indexed", BenchIndexed),
+    ("classes", BenchClasses),
+    ("skip", BenchSkip),
+    ("corpus", BenchCorpus),
+    ("fusion", BenchFusion),
+]
+
+if __name__ == '__main__':
+    names = sys.argv[1:]
+    for (name, bench) in BENCHMARKS:
+        if len(names) == 0 or name in names:
+            bench()
@@ -173,7 +173,7 @@ def produce_impiety():
     loadwestern()
     allsc = allFamilies.AllAvailableSoundChanges()
     sc = allsc['Western-Impiety']
-    impiety = Language.FromSoundChange(western, "Impiety", soundChange.SoundChange.FromSoundChangeList(sc).Apply)
+    impiety = Language.FromSoundChange(western, "Impiety", soundChange.SoundChange.FromSoundChangeList(sc))
 
 def flattenVocab(vocab):
     result = []
@@ -240,4 +240,4 @@ if __name__ == '__main__':
     import soundChange
     sc = soundChange.SoundChange([u"\u0283 > st / _{vowel}"], {"vowel": ipaParse.ALL_VOWELS})
     pnw = allFamilies["ProtoNorthwestern"]
-    fakeNW = Language.FromSoundChange(pnw, "fake northwestern", sc.Apply)
+    fakeNW = Language.FromSoundChange(pnw, "fake northwestern", sc)
@@ -9,6 +9,7 @@ import cmd
 class Interactive(cmd.Cmd):
     def preloop(self):
         self.prompt = "[] > "
+        ipaParse.SaveTables() # so the next start only reads the table cache
         print "Loading families..."
         self.AllFamilies = LoadFromDefault()
         allChildLanguages = self.AllFamilies.AllChildLanguages()
@@ -23,6 +24,8 @@ class Interactive(cmd.Cmd):
         self.CurrentItem = ""
         self.LastList = []
         self.SoundChanges = []
+        self.Combined = None # (rules, SoundChange) last built by CombinedSoundChange
+        self.Checkpoints = {} # language name -> (its words, chunks of soundChange.StageCheckpoints), see CheckpointsFor
         self.SoundChangeSets = self.AllFamilies.AllAvailableSoundChanges()
     def emptyline(self):
         pass
@@ -68,7 +71,7 @@ class Interactive(cmd.Cmd):
             print "ADD SOUND CHANGE FAILED"
             return False
     def help_applysc(self):
-        print "applysc <source_lang> <dest_lang_name> - apply current sc to source_lang to create a new lang named dest_lang_name"
+        print "applysc <source_lang> <dest_lang_name> [workers] - apply current sc to source_lang to create a new lang named dest_lang_name, optionally over several processes"
     def do_applysc(self, line):
         args = line.split(" ")
         sourceName = args[0]
@@ -77,12 +80,56 @@ class Interactive(cmd.Cmd):
             return
         source = self.AllFamilies[sourceName]
         destName = args[1]
+        try:
+            workers = int(args[2]) if len(args) > 2 else 1
+        except ValueError:
+            print "workers should be a number:", args[2]
+            return
         if destName in self.AllFamilies:
             print destName, "already exists."
         else:
-            sc = soundChange.SoundChange.FromSoundChangeList(self.SoundChanges)
-            self.AllFamilies[destName] = Language.FromSoundChange(source, destName, sc.Apply)
+            self.AllFamilies[destName] = Language.FromSoundChange(source, destName, self.CombinedSoundChange(), workers)
             print destName, "added."
+    def help_profilesc(self):
+        print "profilesc [lang] - apply current sc to the words of lang and show the parser nodes that took the most time"
+    def do_profilesc(self, line):
+        source = self.LangFromLineOrCurrent(line)
+        if source != None:
+            sc = soundChange.SoundChange.FromSoundChangeList(self.SoundChanges)
+            ipaParse.EnableProfiling()
+            try:
+                # rule by rule, so the time lands on the parsers rather than the transducers
+                for word in source.Vocabulary.keys() + [x[0] for x in source.Corpus]: sc.ApplyFinal(word)
+            finally:
+                ipaParse.DisableProfiling().Report()
+    def help_rulestats(self):
+        print "rulestats [lang] [file.json] - apply current sc to the words of lang and show what each rule tried, changed and took; optionally save it as JSON"
+    def do_rulestats(self, line):
+        args = line.split()
+        source = self.LangFromLineOrCurrent(args[0] if len(args) > 0 else "")
+        if source != None:
+            sc = soundChange.SoundChange.FromSoundChangeList(self.SoundChanges)
+            stats = sc.EnableStats()
+            sc.ApplyMany(source.Vocabulary.keys() + [x[0] for x in source.Corpus])
+            sc.DisableStats().Report()
+            if len(args) > 1:
+                stats.ToJson(args[1])
+                print "saved to", args[1]
+    def help_fusion(self):
+        print "fusion - show which runs of current sc rules can be fused into one pass, and how many passes that saves"
+    def do_fusion(self, line):
+        print soundChange.SoundChange.FromSoundChangeList(self.SoundChanges).FusionReport().encode("utf-8") # rules are IPA, and stdout may be a pipe
+    def help_checkpoints(self):
+        print "checkpoints - show the per-rule word forms kept for each language, and how many replacements the last update needed"
+    def do_checkpoints(self, line):
+        for (name, (words, chunks)) in self.Checkpoints.items():
+            started = [checkpoints for (kind, items, checkpoints) in chunks if checkpoints != None]
+            print name, ":", len(started), "of", len(chunks), "chunks started"
+            for checkpoints in started: print "   ", checkpoints
+    def help_rulecache(self):
+        print "rulecache - show how many compiled sound change rules are cached, and the cache hits and misses"
+    def do_rulecache(self, line):
+        print soundChange.RULE_CACHE
     def getChangesAndSame(self, source):
         changes = []
         same = []
@@ -97,13 +144,41 @@ class Interactive(cmd.Cmd):
             if (word == result and not(isChange)) or (word != result and isChange):
                 yield (word,result)
     def yieldFromSoundChange(self, source, inclVocab=True, inclCorpus=False):
-        sc = soundChange.SoundChange.FromSoundChangeList(self.SoundChanges)
-        words = []
-        if inclVocab: words.extend(source.Vocabulary.keys())
-        if inclCorpus: words.extend([x[0] for x in source.Corpus])
-        for word in words:
-            result = sc.Apply(word)[-1]
-            yield (word, result)
+        # a chunk at a time, so listing the first few words only sound changes their chunk
+        sc = self.CombinedSoundChange()
+        for chunk in self.CheckpointsFor(source):
+            kind, items, checkpoints = chunk
+            if (kind == "vocab" and not(inclVocab)) or (kind == "corpus" and not(inclCorpus)): continue
+            if checkpoints == None:
+                # corpus lines are kept word by word, see soundChange.SplitLine
+                words = items if kind == "vocab" else soundChange.LineWords(items)[1]
+                checkpoints = chunk[2] = soundChange.StageCheckpoints(words)
+            checkpoints.Update(sc)
+            if kind == "vocab":
+                for (word, result) in zip(items, checkpoints.Final(items)):
+                    yield (word, result)
+            else:
+                splits, words = soundChange.LineWords(items)
+                changed = dict(zip(words, checkpoints.Final(words)))
+                for (line, split) in zip(items, splits):
+                    result = soundChange.JoinLine(split, changed) if split != None else changed[line]
+                    if result == None: result = sc.ApplyMany([line])[0]
+                    yield (line, result)
+    def CheckpointsFor(self, source):
+        """[kind, words or lines, StageCheckpoints or None until first listed] for each chunk of source, started over if its words have changed"""
+        words = (source.Vocabulary.keys(), [x[0] for x in source.Corpus])
+        kept = self.Checkpoints.get(source.Name)
+        if kept == None or kept[0] != words:
+            chunks = [["vocab", chunk, None] for chunk in chunked(words[0], CHECKPOINT_CHUNK_SIZE)]
+            chunks += [["corpus", chunk, None] for chunk in chunked(words[1], CHECKPOINT_CHUNK_SIZE)]
+            kept = self.Checkpoints[source.Name] = (words, chunks)
+        return kept[1]
+    def CombinedSoundChange(self):
+        """The current sound changes as one SoundChange, kept while they stay the same so its ApplyMany memo carries over"""
+        rules = [(sc.OrigRules(), sc.SpecialNames) for sc in self.SoundChanges]
+        if self.Combined == None or self.Combined[0] != rules:
+            self.Combined = (rules, soundChange.SoundChange.FromSoundChangeList(self.SoundChanges))
+        return self.Combined[1]
 
     def LangFromLineOrCurrent(self, line):
         args = line.split(" ")
@@ -180,29 +255,22 @@ class Interactive(cmd.Cmd):
     def help_showcc(self):
         print "showcc [limit [skip]] - show words with two consonants in a row after soundchange, at most limit entries displayed, skipping skip"
     def do_showcc(self, line):
-        limit,skip = self.parseLimitSkip(line)
-        source = self.LangFromLineOrCurrent('') # no lang from line
-        if source != None:
-            self.LastList = []
-            for (orig, word) in take(self.yieldFromSoundChange(source),skip):
-                gs = ipaParse.GraphemeSplit(word)
-                for pair in [(gs[ii],gs[ii+1]) for ii in range(len(gs)-1)]:
-                    if pair[0] in ipaParse.ALL_CONSONANTS and pair[1] in ipaParse.ALL_CONSONANTS:
-                        print word
-                        self.LastList.append(word)
-                        break
-                if limit > 0 and len(self.LastList) >= limit: break
+        self.showadjacent(line, ipaParse.ALL_CONSONANTS)
     def help_showvv(self):
         print "showvv [limit [skip]] - show words with two vowels in a row after soundchange, at most limit entries displayed, skipping skip"
     def do_showvv(self, line):
+        self.showadjacent(line, ipaParse.ALL_VOWELS)
+
+    def showadjacent(self, line, graphemeClass):
         limit,skip = self.parseLimitSkip(line)
         source = self.LangFromLineOrCurrent('') # no lang from line
         if source != None:
             self.LastList = []
+            graphemeClass = frozenset(graphemeClass)
             for (orig, word) in take(self.yieldFromSoundChange(source),skip):
                 gs = ipaParse.GraphemeSplit(word)
-                for pair in [(gs[ii],gs[ii+1]) for ii in range(len(gs)-1)]:
-                    if pair[0] in ipaParse.ALL_VOWELS and pair[1] in ipaParse.ALL_VOWELS:
+                for ii in range(len(gs)-1):
+                    if gs[ii] in graphemeClass and gs[ii+1] in graphemeClass:
                         print word
                         self.LastList.append(word)
                         break
@@ -302,6 +370,19 @@ class Interactive(cmd.Cmd):
         else:
             print "please pass a value or select a current item with enum and pick"
 
+    def help_natclass(self):
+        print "natclass <value> [<value> ...] - list graphemes having all of the given feature values, e.g. natclass voiced fricative"
+    def do_natclass(self, line):
+        try:
+            graphemes = ipaParse.NaturalClass(*line.split())
+        except ipaParse.UnknownFeatureException as e:
+            print "unknown feature value:", e
+            return
+        self.LastList = []
+        for g in sorted(graphemes):
+            print g
+            self.LastList.append(g)
+
     def do_splitcur(self, line):
         if len(self.CurrentItem) == 0:
             print "please pick a current item with enum and pick"
@@ -369,6 +450,17 @@ class Interactive(cmd.Cmd):
     def do_quit(self, line):
         return True
 
+CHECKPOINT_CHUNK_SIZE = 500 # words or corpus lines per StageCheckpoints, so listings only sound change what they show
+
+def chunked(gen, size):
+    chunk = []
+    for x in gen:
+        chunk.append(x)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0: yield chunk
+
 def take(gen, count):
     zip(range(count),gen)
     return gen
@@ -3,11 +3,33 @@
 # IPA-based parser
 #  Understands multi-codepoint graphemes
 
-import copy
+import collections
+import os
+import re
+import sys
 import unicodedata
+from array import array
+from timeit import default_timer as timer
+
+numpy = None # imported by LoadNumPy on first use; it costs more than the rest of startup
+NUMPY_CHECKED = False
+
+def LoadNumPy():
+    """The numpy module, or None if it isn't installed (callers fall back to plain Python)"""
+    global numpy, NUMPY_CHECKED
+    if not(NUMPY_CHECKED):
+        NUMPY_CHECKED = True
+        try:
+            import numpy as numpyModule
+            numpy = numpyModule
+        except ImportError:
+            pass
+    return numpy
 
 ## Config
 WHITESPACE_INCLUDES_NEWLINES = True
+PACKRAT = False # memoize (node, position) results within each top-level Parse, see PackratParse
+PACKRAT_MEMO_LIMIT = 200000 # most memo entries kept per parse, oldest are dropped first
 
 ## Debug and Test Config
 SHOW_PASSES = False
@@ -57,15 +79,6 @@ PLACE = {
     }
 }
 
-PLACE_MINOR = {}
-PLACE_MAJOR = {}
-for major in PLACE.keys():
-    PLACE_MAJOR[major] = u''
-    for minor in PLACE[major].keys():
-        s = PLACE[major][minor]
-        PLACE_MINOR[minor] = s
-        PLACE_MAJOR[major] += s
-
 VOICING = {
     "unvoiced": u'm̥pɸp̪ft̪θn̥tsɬʃʈʂɭ˔̊ɲ̥cçʎ̥˔ŋ̊kxʟ̝̊qχħʡʜʔh',
     "voiced": u'mbβʙⱱ̟ɱb̪vʋⱱn̪d̪ðndzɹrɾɮlɺn̠ʒɳɖʐɻɽɭɺ̠ɲɟʝjʎʎ̯ŋɡgɣɰʟ̝ʟɴɢʁʀɢ̆ʕʢяʡ̯ɦw'
@@ -108,47 +121,181 @@ def CombiningCategory(c):
     cat = unicodedata.category(c)
     return cat[0] == 'M' or cat == 'Lm' or cat == 'Sk'
 
+# Combining-class lookup for the codepoints IPA text actually uses
+#  (Latin, IPA Extensions, Spacing Modifiers, Combining Diacriticals, Greek,
+#  Cyrillic, Phonetic Extensions, Superscripts, Latin Extended-C).
+#  Anything past the table falls back to unicodedata.
+COMBINING_TABLE_LIMIT = 0x3000
+COMBINING_TABLE = None # filled in by LoadTables
+
+def BuildCombiningTable():
+    return bytearray([1 if CombiningCategory(unichr(cp)) else 0 for cp in range(COMBINING_TABLE_LIMIT)])
+
+def IsCombining(c):
+    cp = ord(c)
+    if cp < COMBINING_TABLE_LIMIT: return COMBINING_TABLE[cp] == 1
+    return CombiningCategory(c)
+
+def LeadingCombiningError(s):
+    print s
+    raise Exception("Should not have a combining as first codepoint in grapheme")
+
+def GraphemeEnd(s, start=0, limit=None):
+    """Index just past the grapheme starting at s[start], treating limit as the end of s"""
+    n = len(s) if limit == None else limit
+    ii = start + 1
+    while ii < n and IsCombining(s[ii]):
+        ii += 1
+    return ii
+
+def GraphemeEnds(s):
+    """Single pass over s, returning the end offset of every grapheme"""
+    n = len(s)
+    if n == 0: return []
+    if n > 1 and IsCombining(s[0]): LeadingCombiningError(s)
+    table = COMBINING_TABLE
+    limit = COMBINING_TABLE_LIMIT
+    ends = []
+    for ii in xrange(1, n):
+        cp = ord(s[ii])
+        if cp < limit:
+            if table[cp]: continue
+        elif CombiningCategory(s[ii]): continue
+        ends.append(ii)
+    ends.append(n)
+    return ends
+
 def PopGrapheme(s):
     if len(s) == 0: return None, s
     elif len(s) == 1: return s, ''
-    elif CombiningCategory(s[0]):
-        print s
-        raise Exception("Should not have a combining as first codepoint in grapheme")
+    elif IsCombining(s[0]): LeadingCombiningError(s)
     else:
-        for ii in range(len(s[1:])):
-            if not(CombiningCategory(s[1+ii])):
-                return s[:ii+1], s[ii+1:]
-        return s, ''
+        end = GraphemeEnd(s)
+        return s[:end], s[end:]
+
+def SplitGraphemes(s, errorsTo=None):
+    """GraphemeSplit without the unicode check, for str input that will be coerced anyway"""
+    try:
+        ends = GraphemeEnds(s)
+    except:
+        if errorsTo != None:
+            errorsTo.add(s)
+            return []
+        else:
+            raise
+    graphemeL = []
+    start = 0
+    for end in ends:
+        graphemeL.append(s[start:end])
+        start = end
+    return graphemeL
 
 def GraphemeSplit(s, errorsTo=None):
     if not(type(s) is unicode): raise TypeError("argument should be unicode string, is" + str(type(s)))
-    graphemeL = []
-    while len(s) > 0:
+    return SplitGraphemes(s, errorsTo)
+
+class GraphemeBatch:
+    """
+    Grapheme boundaries for a whole list of words, stored CSR-style:
+     - Text is every word concatenated
+     - GraphemeOffsets[k] is where grapheme k starts in Text, with one
+       trailing entry for the end of the last grapheme
+     - graphemes of word i are k in WordPointers[i]..WordPointers[i+1]
+    Words that fail to split get no graphemes, as with GraphemeSplit.
+    """
+    def __init__(self, words, text, graphemeOffsets, wordPointers):
+        self.Words = words
+        self.Text = text
+        self.GraphemeOffsets = graphemeOffsets
+        self.WordPointers = wordPointers
+    def __repr__(self):
+        return "GraphemeBatch(" + str(len(self.Words)) + " words, " + str(len(self.GraphemeOffsets) - 1) + " graphemes)"
+    def __len__(self):
+        return len(self.Words)
+    def Graphemes(self, ii):
+        text = self.Text
+        offsets = self.GraphemeOffsets
+        return [text[offsets[k]:offsets[k+1]] for k in xrange(self.WordPointers[ii], self.WordPointers[ii+1])]
+    def __iter__(self):
+        for ii in xrange(len(self.Words)):
+            yield self.Graphemes(ii)
+    def AllGraphemes(self):
+        """Every grapheme in the batch, in order (words concatenated)"""
+        text = self.Text
+        offsets = self.GraphemeOffsets
+        return [text[offsets[k]:offsets[k+1]] for k in xrange(len(offsets) - 1)]
+
+if sys.maxunicode > 0xFFFF: CODEPOINT_ENCODING, CODEPOINT_DTYPE = 'utf-32-le', 'uint32'
+else: CODEPOINT_ENCODING, CODEPOINT_DTYPE = 'utf-16-le', 'uint16' # narrow build indexes by code unit
+
+def CodepointArray(text):
+    return numpy.frombuffer(text.encode(CODEPOINT_ENCODING), dtype=CODEPOINT_DTYPE)
+
+def CombiningMask(codepoints):
+    """Vectorized IsCombining over a codepoint array"""
+    inTable = codepoints < COMBINING_TABLE_LIMIT
+    table = numpy.frombuffer(bytes(COMBINING_TABLE), dtype='uint8').astype(bool)
+    mask = table[numpy.where(inTable, codepoints, 0)] & inTable
+    if not(inTable.all()):
+        for cp in numpy.unique(codepoints[~inTable]):
+            if CombiningCategory(unichr(cp)):
+                mask |= (codepoints == cp)
+    return mask
+
+def GraphemeSplitMany(words, errorsTo=None):
+    """GraphemeSplit over a whole list of words at once, see GraphemeBatch"""
+    words = list(words)
+    for word in words:
+        if not(type(word) is unicode): raise TypeError("argument should be unicode string, is" + str(type(word)))
+    if LoadNumPy() == None: return GraphemeSplitManySlow(words, errorsTo)
+    lengths = numpy.fromiter((len(w) for w in words), dtype='int64', count=len(words))
+    wordStarts = numpy.zeros(len(words) + 1, dtype='int64')
+    numpy.cumsum(lengths, out=wordStarts[1:])
+    text = u''.join(words)
+    mask = CombiningMask(CodepointArray(text))
+    multi = numpy.flatnonzero(lengths > 1)
+    bad = multi[mask[wordStarts[multi]]]
+    if len(bad) > 0:
+        # words with a leading combining codepoint split to nothing, so drop them from Text
+        kept = list(words)
+        for ii in bad:
+            if errorsTo == None: LeadingCombiningError(words[ii])
+            errorsTo.add(words[ii])
+            kept[ii] = u''
+        batch = GraphemeSplitMany(kept)
+        batch.Words = words
+        return batch
+    isStart = ~mask
+    isStart[wordStarts[:-1][lengths > 0]] = True
+    starts = numpy.flatnonzero(isStart)
+    offsets = numpy.append(starts, len(text))
+    wordPointers = numpy.searchsorted(starts, wordStarts)
+    return GraphemeBatch(words, text, offsets, wordPointers)
+
+def GraphemeSplitManySlow(words, errorsTo=None):
+    """Same layout as GraphemeSplitMany, one word at a time, for when numpy is missing"""
+    kept = []
+    offsets = array('l')
+    wordPointers = array('l', [0])
+    base = 0
+    for word in words:
         try:
-            g, s = PopGrapheme(s)
+            ends = GraphemeEnds(word)
         except:
-            if errorsTo != None:
-                errorsTo.add(s)
-                return []
-            else:
-                raise
-        if g == None: break
-        graphemeL.append(g)
-    return graphemeL
+            if errorsTo == None: raise
+            errorsTo.add(word)
+            ends = []
+            word = u''
+        kept.append(word)
+        offsets.append(base)
+        offsets.extend([base + end for end in ends[:-1]])
+        if len(ends) == 0: offsets.pop()
+        base += len(word)
+        wordPointers.append(len(offsets))
+    offsets.append(base)
+    return GraphemeBatch(words, u''.join(kept), offsets, wordPointers)
 
-ALL_CONSONANTS = GraphemeSplit(VOICING['unvoiced'] + VOICING['voiced'])
-ALL_VOWELS = GraphemeSplit(ROUNDEDNESS['unrounded'] + ROUNDEDNESS['rounded'])
 ALL_PSEUDO_ALPHA = [u'-'] # so that we can have prefixes and suffixes in dictionary with no parsing trouble
-ALL_ALPHA = ALL_CONSONANTS + ALL_VOWELS + ALL_PSEUDO_ALPHA
-
-
-ConsonantData = {}
-for c in ALL_CONSONANTS:
-    ConsonantData[c] = {}
-VowelData = {}
-for v in ALL_VOWELS:
-    VowelData[v] = {}
-
 
 def FillData(byGrapheme, byType, typeType):
     for t in byType.keys():
@@ -156,38 +303,379 @@ def FillData(byGrapheme, byType, typeType):
         for grapheme in graphemeL:
             byGrapheme[grapheme][typeType] = t
 
-FillData(ConsonantData, MANNER, 'manner')
-FillData(ConsonantData, PLACE_MAJOR, 'place_major')
-FillData(ConsonantData, PLACE_MINOR, 'place_minor')
-FillData(ConsonantData, VOICING, 'voicing')
+# =================================================
+# ========= Derived tables and their cache ========
+# =================================================
+# Everything derived from the tables above can be pickled to TABLE_CACHE_PATH,
+#  so imports only read one file. The cache is keyed on TABLE_CACHE_VERSION
+#  plus a fingerprint of the source tables, so editing MANNER, PLACE, etc. (or
+#  a new unicodedata) makes imports rebuild the tables in memory until the
+#  cache is written again. Importing never writes it: SaveTables does, only
+#  when it is missing or stale, and the console and applySoundChange.py call
+#  it on startup.
+# The tables are loaded at import rather than on first use because they are
+#  plain module constants (ALL_VOWELS, ConsonantData, ...) that the other
+#  modules take with "from ipaParse import *"; Python 2 modules can't compute
+#  an attribute on first access. With a current cache that costs one read.
+#  Set IPAPARSE_TABLE_CACHE to another path, or to "" to turn caching off.
+TABLE_CACHE_VERSION = 1
+TABLE_CACHE_PATH = os.environ.get('IPAPARSE_TABLE_CACHE',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ipaParse.tables'))
+
+def TablesFingerprint():
+    import hashlib
+    def canonical(x):
+        if isinstance(x, dict): return [(k, canonical(x[k])) for k in sorted(x.keys())]
+        return x
+    sources = [TABLE_CACHE_VERSION, MANNER, PLACE, VOICING, BACKNESS, HEIGHT, ROUNDEDNESS,
+        DIACRITICS, SUPRASEGMENTALS, ALL_PSEUDO_ALPHA, COMBINING_TABLE_LIMIT, unicodedata.unidata_version]
+    return hashlib.sha1(repr(canonical(sources))).hexdigest()
+
+def BuildTables():
+    global COMBINING_TABLE
+    COMBINING_TABLE = BuildCombiningTable()
+    placeMinor = {}
+    placeMajor = {}
+    for major in PLACE.keys():
+        placeMajor[major] = u''
+        for minor in PLACE[major].keys():
+            s = PLACE[major][minor]
+            placeMinor[minor] = s
+            placeMajor[major] += s
+    consonants = GraphemeSplit(VOICING['unvoiced'] + VOICING['voiced'])
+    vowels = GraphemeSplit(ROUNDEDNESS['unrounded'] + ROUNDEDNESS['rounded'])
+    consonantData = dict([(c, {}) for c in consonants])
+    vowelData = dict([(v, {}) for v in vowels])
+    FillData(consonantData, MANNER, 'manner')
+    FillData(consonantData, placeMajor, 'place_major')
+    FillData(consonantData, placeMinor, 'place_minor')
+    FillData(consonantData, VOICING, 'voicing')
+    FillData(vowelData, BACKNESS, 'backness')
+    FillData(vowelData, HEIGHT, 'height')
+    FillData(vowelData, ROUNDEDNESS, 'roundedness')
+    return {
+        'fingerprint': TablesFingerprint(),
+        'COMBINING_TABLE': COMBINING_TABLE,
+        'PLACE_MINOR': placeMinor,
+        'PLACE_MAJOR': placeMajor,
+        'ALL_CONSONANTS': consonants,
+        'ALL_VOWELS': vowels,
+        'ConsonantData': consonantData,
+        'VowelData': vowelData,
+        'DIACRITIC_GRAPHEMES': GraphemeSplit(DIACRITICS)}
+
+def ReadTableCache(path):
+    """The tables cached at path if they are current, otherwise None"""
+    import cPickle
+    if not(path): return None
+    try:
+        with open(path, 'rb') as f:
+            tables = cPickle.load(f)
+        if tables.get('fingerprint') == TablesFingerprint(): return tables
+    except Exception:
+        pass # missing, stale or unreadable
+    return None
+
+def LoadTables(path=None):
+    """(tables, whether they came from the cache at path); rebuilt in memory if it is missing or stale, never written"""
+    if path == None: path = TABLE_CACHE_PATH
+    tables = ReadTableCache(path)
+    if tables != None: return tables, True
+    return BuildTables(), False
+
+def SaveTables(path=None):
+    """Write TABLES to the cache at path if it is missing or stale; True if written"""
+    import cPickle
+    if path == None: path = TABLE_CACHE_PATH
+    if not(path): return False
+    if (TABLES_CACHED and path == TABLE_CACHE_PATH) or ReadTableCache(path) != None: return False # already current
+    try:
+        tempPath = path + '.' + str(os.getpid())
+        with open(tempPath, 'wb') as f:
+            cPickle.dump(TABLES, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tempPath, path)
+    except (IOError, OSError):
+        return False # read-only install, just don't cache
+    return True
+
+TABLES, TABLES_CACHED = LoadTables()
+COMBINING_TABLE = TABLES['COMBINING_TABLE']
+PLACE_MINOR = TABLES['PLACE_MINOR']
+PLACE_MAJOR = TABLES['PLACE_MAJOR']
+ALL_CONSONANTS = TABLES['ALL_CONSONANTS']
+ALL_VOWELS = TABLES['ALL_VOWELS']
+ALL_ALPHA = ALL_CONSONANTS + ALL_VOWELS + ALL_PSEUDO_ALPHA
+ALL_ALPHA_SET = frozenset(ALL_ALPHA)
+ConsonantData = TABLES['ConsonantData']
+VowelData = TABLES['VowelData']
+DIACRITIC_GRAPHEMES = TABLES['DIACRITIC_GRAPHEMES']
+
+# (feature, table) pairs, the same ones FillData spreads over ConsonantData/VowelData
+FEATURE_TABLES = [
+    ('manner', MANNER), ('place_major', PLACE_MAJOR), ('place_minor', PLACE_MINOR), ('voicing', VOICING),
+    ('backness', BACKNESS), ('height', HEIGHT), ('roundedness', ROUNDEDNESS)]
+# boolean shorthands accepted by NaturalClass, e.g. voiced=True
+FEATURE_SHORTHANDS = {
+    'voiced': ('voicing', 'voiced', 'unvoiced'),
+    'rounded': ('roundedness', 'rounded', 'unrounded')}
+# features that follow from another: a grapheme moved to a new place_minor gets that place's place_major
+FEATURE_DEPENDENTS = {'place_minor': ['place_major']}
+
+class UnknownFeatureException(Exception): pass
+
+class FeatureMatrix:
+    """
+    One row per consonant/vowel grapheme, one bit per (feature, value).
+    A grapheme listed under several values of a feature (e.g. ʁ as both
+    fricative and approximant) has all of those bits set.
+    """
+    def __init__(self, featureTables=FEATURE_TABLES):
+        self.Bits = {}
+        self.ValueBits = {}
+        for (feature, table) in featureTables:
+            for value in sorted(table.keys()):
+                bit = 1 << len(self.Bits)
+                self.Bits[(feature, value)] = bit
+                self.ValueBits[value] = self.ValueBits.get(value, 0) | bit
+        self.Graphemes = []
+        rowByGrapheme = {}
+        for (feature, table) in featureTables:
+            for value in sorted(table.keys()):
+                for g in SplitGraphemes(table[value]):
+                    if not(g in rowByGrapheme):
+                        rowByGrapheme[g] = 0
+                        self.Graphemes.append(g)
+                    rowByGrapheme[g] |= self.Bits[(feature, value)]
+        self.RowByGrapheme = rowByGrapheme
+        if LoadNumPy() != None and len(self.Bits) <= 64:
+            self.Rows = numpy.array([rowByGrapheme[g] for g in self.Graphemes], dtype='uint64')
+        else:
+            self.Rows = [rowByGrapheme[g] for g in self.Graphemes]
+        self.Cache = {}
+    def __repr__(self):
+        return "FeatureMatrix(" + str(len(self.Graphemes)) + " graphemes, " + str(len(self.Bits)) + " feature values)"
+    def Features(self, g):
+        """Every (feature, value) pair set for grapheme g"""
+        row = self.RowByGrapheme.get(g, 0)
+        return set([fv for (fv, bit) in self.Bits.items() if row & bit])
+    def Masks(self, values, features):
+        """Each mask is one condition: a grapheme must have at least one of its bits"""
+        masks = []
+        for value in values:
+            if not(value in self.ValueBits): raise UnknownFeatureException(value)
+            masks.append(self.ValueBits[value])
+        for (feature, value) in features.items():
+            if feature in FEATURE_SHORTHANDS:
+                feature, yes, no = FEATURE_SHORTHANDS[feature]
+                value = yes if value else no
+            choices = [value] if isinstance(value, basestring) else value
+            mask = 0
+            for choice in choices:
+                if not((feature, choice) in self.Bits): raise UnknownFeatureException((feature, choice))
+                mask |= self.Bits[(feature, choice)]
+            masks.append(mask)
+        return tuple(sorted(set(masks)))
+    def Shift(self, *values):
+        """
+        Grapheme -> grapheme dict moving each grapheme into Query(*values)
+        while keeping its other features, e.g. Shift('nasal') takes c to ɲ̥.
+        Graphemes with no single such counterpart are left out.
+        """
+        key = ('shift',) + tuple(sorted(values))
+        if key in self.Cache: return self.Cache[key]
+        changed = set()
+        for value in values:
+            if not(value in self.ValueBits): raise UnknownFeatureException(value)
+            changed.update([feature for ((feature, v), bit) in self.Bits.items() if v == value])
+        for feature in list(changed): changed.update(FEATURE_DEPENDENTS.get(feature, []))
+        kept = 0
+        for ((feature, v), bit) in self.Bits.items():
+            if not(feature in changed): kept |= bit
+        targets = {}
+        for g in self.Query(*values):
+            targets.setdefault(self.RowByGrapheme[g] & kept, []).append(g)
+        result = {}
+        for g in self.Graphemes:
+            counterparts = targets.get(self.RowByGrapheme[g] & kept, [])
+            if len(counterparts) == 1: result[g] = counterparts[0]
+        self.Cache[key] = result
+        return result
+    def Query(self, *values, **features):
+        """
+        Graphemes having every given feature value, e.g.
+        Query('alveolar', 'fricative') or Query(voiced=True, manner='fricative').
+        A list of values for one feature means any of them.
+        """
+        masks = self.Masks(values, features)
+        if masks in self.Cache: return self.Cache[masks]
+        if not(isinstance(self.Rows, list)):
+            selected = numpy.ones(len(self.Graphemes), dtype=bool)
+            for mask in masks:
+                selected &= (self.Rows & numpy.uint64(mask)) != 0
+            result = frozenset([self.Graphemes[ii] for ii in numpy.flatnonzero(selected)])
+        else:
+            result = frozenset([g for (g, row) in zip(self.Graphemes, self.Rows) if all([row & mask for mask in masks])])
+        self.Cache[masks] = result
+        return result
+
+FEATURES = None # built by Features on first use
 
-FillData(VowelData, BACKNESS, 'backness')
-FillData(VowelData, HEIGHT, 'height')
-FillData(VowelData, ROUNDEDNESS, 'roundedness')
+def Features():
+    global FEATURES
+    if FEATURES == None: FEATURES = FeatureMatrix()
+    return FEATURES
+
+def NaturalClass(*values, **features):
+    """Cached frozenset of graphemes sharing the given feature values, see FeatureMatrix.Query"""
+    return Features().Query(*values, **features)
+
+def FeatureShift(*values):
+    """Cached dict taking graphemes to their counterparts with the given feature values, see FeatureMatrix.Shift"""
+    return Features().Shift(*values)
+
+class GraphemeTrie:
+    """
+    A trie over graphemes for a set of patterns (unicode strings or
+    grapheme sequences). State 0 is the root; Goto[state] maps a grapheme
+    to the next state, and Accept[state] is the pattern length if the path
+    to state is a pattern.
+    """
+    def __init__(self, patterns):
+        self.Patterns = []
+        self.Goto = [{}]
+        self.Accept = [None]
+        for pattern in patterns:
+            graphemes = tuple(SplitGraphemes(pattern)) if isinstance(pattern, basestring) else tuple(pattern)
+            if len(graphemes) == 0 or graphemes in self.Patterns: continue
+            self.Patterns.append(graphemes)
+            state = 0
+            for g in graphemes:
+                if not(g in self.Goto[state]):
+                    self.Goto.append({})
+                    self.Accept.append(None)
+                    self.Goto[state][g] = len(self.Goto) - 1
+                state = self.Goto[state][g]
+            self.Accept[state] = len(graphemes)
+    def __repr__(self):
+        return "GraphemeTrie(" + str(len(self.Patterns)) + " patterns, " + str(len(self.Goto)) + " states)"
+    def FirstChars(self):
+        return frozenset([g[0] for g in self.Goto[0].keys()])
+    def LongestAt(self, text, pos, limit):
+        """End of the longest pattern starting at text[pos], None if none does"""
+        state = 0
+        best = None
+        p = pos
+        while p < limit:
+            end = GraphemeEnd(text, p, limit)
+            state = self.Goto[state].get(text[p:end])
+            if state == None: break
+            p = end
+            if self.Accept[state] != None: best = p
+        return best
 
 # swm -- past here, I can't see that anything valuable is happening.
 
-class ParserNode:
+class PackratMemo:
+    """(node, position) -> parse outcome for one top-level parse, oldest entries dropped past limit"""
+    def __init__(self, limit=None):
+        self.Limit = limit if limit != None else PACKRAT_MEMO_LIMIT
+        self.Table = {}
+        self.Order = collections.deque()
+    def Put(self, key, outcome):
+        if len(self.Table) >= self.Limit:
+            del self.Table[self.Order.popleft()]
+        self.Table[key] = outcome
+        self.Order.append(key)
+
+def PackratParse(node, s0, memoLimit=None):
+    """node.Parse(s0), remembering every (node, position) outcome so nothing is parsed twice at the same place"""
+    end, res = node.ParseAt(s0, 0, len(s0), PackratMemo(memoLimit))
+    return s0[end:], res
+
+class ParseResult(object):
+    """
+    One node of a parse tree: the grammar Node that matched, the span
+    Start..End of the shared Buffer it covers, and the results of its parsed
+    sub-nodes. Results are never modified once built, and grammar nodes keep
+    no parse state, so one grammar can serve any number of parses at once.
+    What the Children are, and how they are read, is up to the grammar node.
+    """
+    __slots__ = ('Node', 'Name', 'Buffer', 'Start', 'End', 'Children')
+    def __init__(self, node, buffer, start, end, children=()):
+        self.Node = node
+        self.Name = node.Name
+        self.Buffer = buffer
+        self.Start = start
+        self.End = end
+        self.Children = children
+    def __repr__(self):
+        return "ParseResult(" + str(self.Node) + ", " + str(self.Start) + ", " + str(self.End) + ")"
+    @property
+    def Text(self):
+        return self.Buffer[self.Start:self.End]
+    def GetParsedResult(self):
+        return self.Node.ResultValue(self)
+    def FindAll(self, name):
+        return self.Node.ResultFindAll(self, name)
+    def ReplaceWith(self, d):
+        return self.Node.ResultReplaceWith(self, d)
+
+class SelectionResult(ParseResult):
+    __slots__ = ()
+    def GetSelectionName(self):
+        """Call this method directly (it isn't recursive) to determine what, if anything, was selected"""
+        return self.Node.ResultSelectionName(self)
+
+def Replacement(value, text):
+    """What ReplaceWith puts in place of text matched by a name mapped to value: value, or for a dict value.get(text, text)"""
+    if isinstance(value, dict): return value.get(text, text)
+    return value
+
+WHITESPACE_CHARS = frozenset([unichr(cp) for cp in range(0x3001) if unichr(cp).isspace()])
+
+class ParserNode(object):
+    """
+    Grammar node. Parsing works on a shared buffer: ParseAt(text, pos, limit)
+    treats text[pos:limit] as the input and returns (end, ParseResult), or
+    (pos, None) on failure. Subclasses implement DoParse, and ResultValue,
+    ResultFindAll and ResultReplaceWith to interpret their results' Children.
+    """
+    ResultType = ParseResult
     def __init__(self, name=None):
         self.Name = name
         self.Tag = None
+    def Parse(self, s0):
+        end, res = self.ParseAt(s0, 0, len(s0))
+        return s0[end:], res
+    def ParseAt(self, text, pos, limit, memo=None):
+        if memo == None:
+            if not(PACKRAT): return self.DoParse(text, pos, limit, None)
+            memo = PackratMemo()
+        key = (id(self), pos, limit)
+        outcome = memo.Table.get(key)
+        if outcome == None:
+            outcome = self.DoParse(text, pos, limit, memo)
+            memo.Put(key, outcome)
+        return outcome
     def Recognize(self, s0):
         s1, res = self.Parse(s0)
         return s1, res != None
-    def Parsed(self, s0, s1):
-        n = copy.copy(self)
-        n.Text = s0[:len(s0)-len(s1)]
-        return s1, n
-    def Parsing(self):
-        self.Text = None
-    def FindAll(self, name):
-        if self.Name == name and self.Text != None: return [self]
+    def FirstChars(self):
+        """
+        The codepoints this node can start at: when pos < limit it only ever
+        succeeds if text[pos] is one of them. None means it could be anything.
+        """
+        return None
+    def Parsed(self, text, start, end, children=()):
+        return end, self.ResultType(self, text, start, end, children)
+    def ResultFindAll(self, res, name):
+        if self.Name == name: return [res]
         else: return []
-    def ReplaceWith(self, d):
-        if self.Name in d.keys():
-            return d[self.Name]
+    def ResultReplaceWith(self, res, d):
+        if self.Name in d:
+            return Replacement(d[self.Name], res.Text)
         else:
-            return self.Text
+            return res.Text
 
 def WeaveAndClean(l1, l2):
     result = []
@@ -212,27 +700,31 @@ class SeparatedSequenceNode (ParserNode):
         if self.FinalSep: final = ", finalSep=True"
         if not(self.StoreSep): store = ", storeSep=False"
         return "SeparatedSequenceNode(" + str(self.SepNode) + ", " + str(self.Nodes) + initial + final + store + ")"
-    def Parse(self, s0):
-        self.Parsing()
-        self.ParsedNodes = []
-        self.Separators = []
-        s1 = s0
+    def FirstChars(self):
+        if self.InitialSep: return self.SepNode.FirstChars()
+        elif len(self.Nodes) > 0: return self.Nodes[0].FirstChars()
+        else: return None
+    def DoParse(self, text, pos, limit, memo):
+        parsedNodes = []
+        separators = []
+        p = pos
         if self.InitialSep:
-            s1, res = self.SepNode.Parse(s1)
-            if res == None: return s0, None
-            self.Separators.append(res)
+            p, res = self.SepNode.ParseAt(text, p, limit, memo)
+            if res == None: return pos, None
+            separators.append(res)
         for ii in range(len(self.Nodes)):
             node = self.Nodes[ii]
-            s1,res = node.Parse(s1)
+            p,res = node.ParseAt(text, p, limit, memo)
             if res == None:
-                return s0, None
-            self.ParsedNodes.append(res)
+                return pos, None
+            parsedNodes.append(res)
             if self.FinalSep or (ii != len(self.Nodes) - 1):
-                s1,res = self.SepNode.Parse(s1)
+                p,res = self.SepNode.ParseAt(text, p, limit, memo)
                 if res == None:
-                    return s0, None
-                if self.StoreSep: self.Separators.append(res)
-        return self.Parsed(s0, s1)
+                    return pos, None
+                if self.StoreSep: separators.append(res)
+        # Children: (parsed nodes, parsed separators)
+        return self.Parsed(text, pos, p, (tuple(parsedNodes), tuple(separators)))
     def __WeaveAndClean(self, nodes, sep):
         if not(self.StoreSep):
             return [node for node in nodes if node != None]
@@ -240,28 +732,31 @@ class SeparatedSequenceNode (ParserNode):
             return WeaveAndClean(sep, nodes)
         else:
             return WeaveAndClean(nodes, sep)
-    def GetParsedResult(self):
-        if len(self.ParsedNodes) == 0:
+    def ResultValue(self, res):
+        parsedNodes, separators = res.Children
+        if len(parsedNodes) == 0:
             return None
         else:
-            nodes = [n.GetParsedResult() for n in self.ParsedNodes]
+            nodes = [n.GetParsedResult() for n in parsedNodes]
             if not(self.StoreSep): return nodes
-            sep = [n.GetParsedResult() for n in self.Separators]
+            sep = [n.GetParsedResult() for n in separators]
             return self.__WeaveAndClean(nodes, sep)
-    def FindAll(self, name):
-        results = ParserNode.FindAll(self, name)
-        for node in self.__WeaveAndClean(self.ParsedNodes, self.Separators):
+    def ResultFindAll(self, res, name):
+        parsedNodes, separators = res.Children
+        results = ParserNode.ResultFindAll(self, res, name)
+        for node in self.__WeaveAndClean(parsedNodes, separators):
             results.extend(node.FindAll(name))
         return results
-    def ReplaceWith(self, d):
-        if len(self.ParsedNodes) == 0:
+    def ResultReplaceWith(self, res, d):
+        parsedNodes, separators = res.Children
+        if len(parsedNodes) == 0:
             return None
-        if self.Name in d.keys():
-            return d[self.Name]
+        if self.Name in d:
+            return Replacement(d[self.Name], res.Text)
         else:
-            nodes = [n.ReplaceWith(d) for n in self.ParsedNodes]
+            nodes = [n.ReplaceWith(d) for n in parsedNodes]
             if not(self.StoreSep): return ''.join(nodes)
-            sep = [n.ReplaceWith(d) for n in self.Separators]
+            sep = [n.ReplaceWith(d) for n in separators]
             return ''.join(self.__WeaveAndClean(nodes, sep))
 
 class SequenceNode (ParserNode):
@@ -270,106 +765,119 @@ class SequenceNode (ParserNode):
         self.Nodes = [node for node in nodes]
     def __repr__(self):
         return "SequenceNode(" + str(self.Nodes) + ")"
-    def Parse(self, s0):
-        self.Parsing()
-        self.ParsedNodes = []
-        s1 = s0
+    def FirstChars(self):
+        if len(self.Nodes) > 0: return self.Nodes[0].FirstChars()
+        else: return None
+    def DoParse(self, text, pos, limit, memo):
+        parsedNodes = []
+        p = pos
         for node in self.Nodes:
-            s1,res = node.Parse(s1)
-            if res == None: return s0, None
-            self.ParsedNodes.append(res)
-        return self.Parsed(s0, s1)
-    def GetParsedResult(self):
-        if len(self.ParsedNodes) == 0:
+            p,res = node.ParseAt(text, p, limit, memo)
+            if res == None: return pos, None
+            parsedNodes.append(res)
+        return self.Parsed(text, pos, p, tuple(parsedNodes))
+    def ResultValue(self, res):
+        if len(res.Children) == 0:
             return None
         else:
-            return [x for x in [n.GetParsedResult() for n in self.ParsedNodes] if x != None]
-    def FindAll(self, name):
-        results = ParserNode.FindAll(self, name)
-        for node in self.ParsedNodes:
+            return [x for x in [n.GetParsedResult() for n in res.Children] if x != None]
+    def ResultFindAll(self, res, name):
+        results = ParserNode.ResultFindAll(self, res, name)
+        for node in res.Children:
             results.extend(node.FindAll(name))
         return results
-    def ReplaceWith(self, d):
-        if len(self.ParsedNodes) == 0:
+    def ResultReplaceWith(self, res, d):
+        if len(res.Children) == 0:
             return None
-        elif self.Name in d.keys():
-            return d[self.Name]
+        elif self.Name in d:
+            return Replacement(d[self.Name], res.Text)
         else:
-            replaced = [n.ReplaceWith(d) for n in self.ParsedNodes]
+            replaced = [n.ReplaceWith(d) for n in res.Children]
             return ''.join([r for r in replaced if r != None])
     
 class OrNode (ParserNode):
     def __init__(self, nodes, name=None):
         ParserNode.__init__(self, name)
         self.Nodes = [node for node in nodes]
+        self.BuildDispatch()
     def __repr__(self):
         return "OrNode(" + str(self.Nodes) + ")"
-    def Parse(self, s0):
-        self.Parsing()
-        self.ParsedNode = None
-        for node in self.Nodes:
-            s1,res = node.Parse(s0)
+    def BuildDispatch(self):
+        """Dispatch: first codepoint -> the options that can start with it, in order; Anywhere: options for any other codepoint"""
+        firsts = [node.FirstChars() for node in self.Nodes]
+        self.Anywhere = [node for (node, first) in zip(self.Nodes, firsts) if first == None]
+        self.Dispatch = {}
+        for c in set().union(*[first for first in firsts if first != None]):
+            self.Dispatch[c] = [node for (node, first) in zip(self.Nodes, firsts) if first == None or c in first]
+    def FirstChars(self):
+        if len(self.Anywhere) > 0: return None
+        return frozenset(self.Dispatch.keys())
+    def DoParse(self, text, pos, limit, memo):
+        nodes = self.Nodes
+        if pos < limit:
+            nodes = self.Dispatch.get(text[pos])
+            if nodes == None:
+                # a combining codepoint can't start anything, but a GraphemeNode
+                #  complains about it, so try every option as before
+                nodes = self.Nodes if IsCombining(text[pos]) else self.Anywhere
+        for node in nodes:
+            end,res = node.ParseAt(text, pos, limit, memo)
             if res != None:
-                self.ParsedNode = res
-                return self.Parsed(s0, s1)
-        return s0, None
-    def GetParsedResult(self):
-        return self.ParsedNode.GetParsedResult()
-    def FindAll(self, name):
-        results = ParserNode.FindAll(self, name)
-        results.extend(self.ParsedNode.FindAll(name))
+                return self.Parsed(text, pos, end, (res,))
+        return pos, None
+    def ResultValue(self, res):
+        return res.Children[0].GetParsedResult()
+    def ResultFindAll(self, res, name):
+        results = ParserNode.ResultFindAll(self, res, name)
+        results.extend(res.Children[0].FindAll(name))
         return results
-    def ReplaceWith(self, d):
-        if self.ParsedNode == None:
-            return None
-        elif self.Name in d.keys():
-            return d[self.Name]
+    def ResultReplaceWith(self, res, d):
+        if self.Name in d:
+            return Replacement(d[self.Name], res.Text)
         else:
-            return self.ParsedNode.ReplaceWith(d)
+            return res.Children[0].ReplaceWith(d)
 
 class GraphemeNode (ParserNode):
     def __init__(self, graphemes, name=None):
         ParserNode.__init__(self, name)
-        s = u''.join(graphemes)
-        self.Graphemes = []
-        while len(s) > 0:
-            g, s = PopGrapheme(s)
-            self.Graphemes.append(g)
+        self.Graphemes = SplitGraphemes(u''.join(graphemes))
+        self.GraphemeSet = frozenset(self.Graphemes)
     def __repr__(self):
         if self.Name != None: nameStr = ", name='" + self.Name + "'"
         else: nameStr = ""
         return "GraphemeNode(" + str(self.Graphemes) + nameStr + ")"
-    def Parse(self, s0):
-        self.Parsing()
-        self.ParsedGrapheme = None
-        if len(s0) == 0: return s0, None
-        g, s1 = PopGrapheme(s0)
-        if g in self.Graphemes:
-            self.ParsedGrapheme = g
-            return self.Parsed(s0, s1)
-        return s0, None
-    def GetParsedResult(self):
-        return self.ParsedGrapheme
+    def FirstChars(self):
+        return frozenset([g[0] for g in self.Graphemes])
+    def DoParse(self, text, pos, limit, memo):
+        if pos >= limit: return pos, None
+        if limit - pos > 1 and IsCombining(text[pos]): LeadingCombiningError(text[pos:limit])
+        end = GraphemeEnd(text, pos, limit)
+        if text[pos:end] in self.GraphemeSet:
+            return self.Parsed(text, pos, end)
+        return pos, None
+    def ResultValue(self, res):
+        return res.Text
 
 class WhitespaceNode (ParserNode):
     def __init__(self, name=None):
         ParserNode.__init__(self, name)
     def __repr__(self):
         return "WhitespaceNode()"
-    def Parse(self, s0):
-        self.Parsing()
-        if (len(s0) == 0): return s0, None
-        for ii in range(len(s0)):
-            if (not(s0[ii].isspace())
+    def FirstChars(self):
+        return WHITESPACE_CHARS
+    def DoParse(self, text, pos, limit, memo):
+        if pos >= limit: return pos, None
+        for ii in xrange(pos, limit):
+            if (not(text[ii].isspace())
                 or (not(WHITESPACE_INCLUDES_NEWLINES)
-                    and (s0[ii] == '\n' or s0[ii] == '\r')
+                    and (text[ii] == '\n' or text[ii] == '\r')
                 )):
-                if ii > 0:
-                    return self.Parsed(s0, s0[ii:])
-                else: return s0, None
-        return self.Parsed(s0, u'')
-    def GetParsedResult(self):
-        return self.Text
+                if ii > pos:
+                    return self.Parsed(text, pos, ii)
+                else: return pos, None
+        return self.Parsed(text, pos, limit)
+    def ResultValue(self, res):
+        return res.Text
 
 class OptionalNode (ParserNode):
     def __init__(self, node, name=None):
@@ -377,72 +885,65 @@ class OptionalNode (ParserNode):
         self.Node = node
     def __repr__(self):
         return "OptionalNode(" + str(self.Node) + ")"
-    def Parse(self, s0):
-        self.Parsing()
-        s1, res = self.Node.Parse(s0)
-        self.Chosen = res
-        return self.Parsed(s0, s1)
-    def GetParsedResult(self):
-        if self.Chosen == None: return None
-        else: return self.Chosen.GetParsedResult()
-    def FindAll(self, name):
-        results = ParserNode.FindAll(self, name)
-        if self.Chosen != None:
-            results.extend(self.Chosen.FindAll(name))
+    def DoParse(self, text, pos, limit, memo):
+        end, res = self.Node.ParseAt(text, pos, limit, memo)
+        return self.Parsed(text, pos, end, (res,) if res != None else ())
+    def ResultValue(self, res):
+        if len(res.Children) == 0: return None
+        else: return res.Children[0].GetParsedResult()
+    def ResultFindAll(self, res, name):
+        results = ParserNode.ResultFindAll(self, res, name)
+        if len(res.Children) > 0:
+            results.extend(res.Children[0].FindAll(name))
         return results
-    def ReplaceWith(self, d):
-        if self.Chosen == None:
+    def ResultReplaceWith(self, res, d):
+        if len(res.Children) == 0:
             return ''
-        elif self.Name in d.keys():
-            return d[self.Name]
+        elif self.Name in d:
+            return Replacement(d[self.Name], res.Text)
         else:
-            return self.Chosen.ReplaceWith(d)
+            return res.Children[0].ReplaceWith(d)
 
 class ManyNode (ParserNode):
     def __init__(self, node, name=None):
         if not(isinstance(node, ParserNode)): raise Exception("ManyNode expects a node: " + str(node))
         ParserNode.__init__(self, name)
         self.Node = node
-        self.ParsedNodes = []
     def __repr__(self):
         return "ManyNode(" + str(self.Node) + ")"
-    def Parse(self, s0):
-        self.Parsing()
-        self.ParsedNodes = []
-        s1 = s0
-        if len(s0) == 0:
-            s1, res = self.Node.Parse(u'')
+    def FirstChars(self):
+        return self.Node.FirstChars()
+    def DoParse(self, text, pos, limit, memo):
+        parsedNodes = []
+        p = pos
+        if pos >= limit:
+            p, res = self.Node.ParseAt(text, pos, limit, memo)
             if (res == None):
-                return s0, None
+                return pos, None
             else:
-                self.ParsedNodes.append(res)
-        while len(s1) > 0:
-            pending,res = self.Node.Parse(s1)
-            if res == None or (pending == s1 and len(self.ParsedNodes) > 0):
+                parsedNodes.append(res)
+        while p < limit:
+            pending,res = self.Node.ParseAt(text, p, limit, memo)
+            if res == None or (pending == p and len(parsedNodes) > 0):
                 break
-            self.ParsedNodes.append(res)
-            s1 = pending
-        if len(self.ParsedNodes) > 0:
-            return self.Parsed(s0, s1)
-        else:
-            return s0, None
-    def GetParsedResult(self):
-        if len(self.ParsedNodes) == 0:
-            return None
+            parsedNodes.append(res)
+            p = pending
+        if len(parsedNodes) > 0:
+            return self.Parsed(text, pos, p, tuple(parsedNodes))
         else:
-            return [n.GetParsedResult() for n in self.ParsedNodes]
-    def FindAll(self, name):
-        results = ParserNode.FindAll(self, name)
-        for node in self.ParsedNodes:
+            return pos, None
+    def ResultValue(self, res):
+        return [n.GetParsedResult() for n in res.Children]
+    def ResultFindAll(self, res, name):
+        results = ParserNode.ResultFindAll(self, res, name)
+        for node in res.Children:
             results.extend(node.FindAll(name))
         return results
-    def ReplaceWith(self, d):
-        if len(self.ParsedNodes) == 0:
-            return None
-        elif self.Name in d.keys():
-            return d[self.Name]
+    def ResultReplaceWith(self, res, d):
+        if self.Name in d:
+            return Replacement(d[self.Name], res.Text)
         else:
-            return ''.join([n.ReplaceWith(d) for n in self.ParsedNodes])
+            return ''.join([n.ReplaceWith(d) for n in res.Children])
 
 # =================================================
 # ============ Composite Helper Nodes =============
@@ -481,29 +982,31 @@ class EndNode (ParserNode):
         self.WhitespaceAndEOL = OptionalNode(ManyNode(OrNode([WhitespaceNode(), EOLNode()])))
     def __repr__(self):
         return "EndNode()"
-    def Parse(self, s0):
-        self.Parsing()
-        s1, res = self.WhitespaceAndEOL.Parse(s0)
-        if res != None and s1 == '':
-            return self.Parsed(s0, s1)
+    def FirstChars(self):
+        # short of the end, it has to eat whitespace and newlines up to it
+        return WHITESPACE_CHARS
+    def DoParse(self, text, pos, limit, memo):
+        end, res = self.WhitespaceAndEOL.ParseAt(text, pos, limit, memo)
+        if res != None and end == limit:
+            return self.Parsed(text, pos, end)
         else:
-            return s0, None
-    def GetParsedResult(self):
-        return self.Text
+            return pos, None
+    def ResultValue(self, res):
+        return res.Text
 
 class MustBeNamedException(Exception): pass
 
 class SelectNameOneOfOrNoneNode(OptionalNode):
+    ResultType = SelectionResult
     def __init__(self, namedOptionNodes, name=None):
         L = [n for n in namedOptionNodes if n.Name != None]
         if len(L) != len(namedOptionNodes): raise MustBeNamedException()
         OptionalNode.__init__(self, OrNode(L), name)
     def __repr__(self):
         return "SelectNameOneOfOrNoneNode(" + str(self.Node.Nodes) + ")"
-    def GetSelectionName(self):
-        """Call this method directly (it isn't recursive) to determine what, if anything, was selected"""
-        if self.Text != None and self.Text != "":
-            return self.Node.ParsedNode.Name
+    def ResultSelectionName(self, res):
+        if res.Text != "":
+            return res.Children[0].Children[0].Name
         else:
             return None
 
@@ -519,6 +1022,13 @@ class UnderscoreNode(GraphemeNode):
     def __repr__(self):
         return "UnderscoreNode()"
 
+def ParsesOneGrapheme(node):
+    """True if node consumes at most the one grapheme at its position, and looks no further"""
+    if isinstance(node, GraphemeNode): return True
+    elif isinstance(node, OptionalNode): return ParsesOneGrapheme(node.Node)
+    elif type(node) is OrNode: return all([ParsesOneGrapheme(n) for n in node.Nodes])
+    return False
+
 class ManyEndsWithSubsetNode(ParserNode):
     """e.g. Seq(Many(Alpha), Grapheme(a))... needed because no backtracking normally."""
     def __init__(self, manyOfNode, endsWithNode, backtrackStepSize, name=None):
@@ -526,43 +1036,76 @@ class ManyEndsWithSubsetNode(ParserNode):
         self.Many = ManyNode(manyOfNode)
         self.EndsWith = endsWithNode
         self.BacktrackStepSize = backtrackStepSize
+        # then the Many parse holds one result per grapheme, and the Many
+        #  parse of any shorter prefix is just the first few of them
+        self.OneGraphemeEach = ParsesOneGrapheme(manyOfNode)
     def __repr__(self):
         vals = [self.Many.Node, self.EndsWith, self.BacktrackStepSize]
         s = ",".join([str(val) for val in vals])
         return "ManyEndsWithSubsetNode(" + s + ")"
-    def Parse(self, s0):
-        self.Parsing()
-        self.ParsedMany = None
-        self.ParsedEndsWith = None
-        s1, res = self.Many.Parse(s0)
-        if res == None: return s0, None
-        L = GraphemeSplit(res.Text)
-        for backtrack in range(self.BacktrackStepSize, len(L)+1, self.BacktrackStepSize):
-            s1a, resa = self.Many.Parse(''.join(L[0:-backtrack]))
-            if resa == None: continue
-            s1b, resb = self.EndsWith.Parse(''.join(L[-backtrack:]))
+    def FirstChars(self):
+        return self.Many.FirstChars()
+    def DoParse(self, text, pos, limit, memo):
+        manyEnd, res = self.Many.ParseAt(text, pos, limit, memo)
+        if res == None: return pos, None
+        if not(type(text) is unicode): raise TypeError("argument should be unicode string, is" + str(type(text)))
+        starts = []
+        p = pos
+        while p < manyEnd:
+            starts.append(p)
+            p = GraphemeEnd(text, p, manyEnd)
+        # try EndsWith at each recorded grapheme start, right to left, with
+        #  the Many part being whatever parses before that start
+        for backtrack in range(self.BacktrackStepSize, len(starts)+1, self.BacktrackStepSize):
+            kept = len(starts) - backtrack
+            cut = starts[kept]
+            if self.OneGraphemeEach and kept > 0:
+                endb, resb = self.EndsWith.ParseAt(text, cut, manyEnd, memo)
+                if resb == None: continue
+                enda, resa = self.Many.Parsed(text, pos, cut, res.Children[0:kept])
+            else:
+                enda, resa = self.Many.ParseAt(text, pos, cut, memo)
+                if resa == None: continue
+                endb, resb = self.EndsWith.ParseAt(text, cut, manyEnd, memo)
             if resb != None:
-                self.ParsedMany = resa
-                self.ParsedEndsWith = resb
-                return self.Parsed(s0, s1b+s1)
-        return s0, None
-    def GetParsedResult(self):
-        if self.ParsedMany == None:
-            return None
-        else:
-            return self.ParsedMany.GetParsedResult() + [self.ParsedEndsWith.GetParsedResult()]
-    def FindAll(self, name):
-        results = ParserNode.FindAll(self, name)
-        results.extend(self.ParsedMany.FindAll(name))
-        results.extend(self.ParsedEndsWith.FindAll(name))
+                # Children: (parsed many, parsed ending)
+                return self.Parsed(text, pos, endb, (resa, resb))
+        return pos, None
+    def ResultValue(self, res):
+        parsedMany, parsedEndsWith = res.Children
+        return parsedMany.GetParsedResult() + [parsedEndsWith.GetParsedResult()]
+    def ResultFindAll(self, res, name):
+        parsedMany, parsedEndsWith = res.Children
+        results = ParserNode.ResultFindAll(self, res, name)
+        results.extend(parsedMany.FindAll(name))
+        results.extend(parsedEndsWith.FindAll(name))
         return results
-    def ReplaceWith(self, d):
-        if self.ParsedMany == None:
-            return None
-        elif self.Name in d.keys():
-            return d[self.Name]
+    def ResultReplaceWith(self, res, d):
+        parsedMany, parsedEndsWith = res.Children
+        if self.Name in d:
+            return Replacement(d[self.Name], res.Text)
         else:
-            return self.ParsedMany.ReplaceWith(d) + self.ParsedEndsWith.ReplaceWith(d)
+            return parsedMany.ReplaceWith(d) + parsedEndsWith.ReplaceWith(d)
+
+class PatternSetNode(ParserNode):
+    """The longest of several grapheme patterns starting here, found by walking a GraphemeTrie"""
+    def __init__(self, patterns, name=None):
+        ParserNode.__init__(self, name)
+        self.Trie = GraphemeTrie(patterns)
+    def __repr__(self):
+        if self.Name != None: nameStr = ", name='" + self.Name + "'"
+        else: nameStr = ""
+        return "PatternSetNode(" + str([u''.join(p) for p in self.Trie.Patterns]) + nameStr + ")"
+    def FirstChars(self):
+        return self.Trie.FirstChars()
+    def DoParse(self, text, pos, limit, memo):
+        if pos >= limit: return pos, None
+        if limit - pos > 1 and IsCombining(text[pos]): LeadingCombiningError(text[pos:limit])
+        end = self.Trie.LongestAt(text, pos, limit)
+        if end == None: return pos, None
+        return self.Parsed(text, pos, end)
+    def ResultValue(self, res):
+        return res.Text
 
 class WhitespaceOrPunctuationNode(ManyNode):
     def __init__(self, name=None):
@@ -577,6 +1120,347 @@ class GroupNode(SequenceNode):
         s = ",".join([str(val) for val in self.Nodes])
         return "GroupNode(" + s + ")"
 
+# =================================================
+# =============== Compiled Parsers ================
+# =================================================
+class NotRegularException(Exception): pass
+
+def CharClass(chars):
+    """re character class source matching any one of chars"""
+    return u'[' + u''.join([re.escape(c) for c in chars]) + u']'
+
+def CombiningClass():
+    """re character class of the combining codepoints below COMBINING_TABLE_LIMIT"""
+    ranges = []
+    start = None
+    for cp in range(COMBINING_TABLE_LIMIT + 1):
+        combining = cp < COMBINING_TABLE_LIMIT and COMBINING_TABLE[cp] == 1
+        if combining and start == None: start = cp
+        elif not(combining) and start != None:
+            ranges.append(re.escape(unichr(start)) + u'-' + re.escape(unichr(cp - 1)))
+            start = None
+    return u'[' + u''.join(ranges) + u']'
+
+COMBINING_CLASS = None # built on first compile
+
+# Text the compiled patterns don't understand: a combining codepoint where
+#  the interpreter would start a grapheme (and complain), or anything the
+#  COMBINING_CLASS doesn't cover. Such text is parsed by the interpreter.
+REGEX_UNSAFE_TEXT = None
+
+def LoadRegexTables():
+    global COMBINING_CLASS, REGEX_UNSAFE_TEXT
+    if COMBINING_CLASS == None:
+        COMBINING_CLASS = CombiningClass()
+        REGEX_UNSAFE_TEXT = re.compile(ur'(?:\A|\s)' + COMBINING_CLASS + u'|[^\x00-' + unichr(COMBINING_TABLE_LIMIT - 1) + u']', re.UNICODE)
+
+def RegexUnsafe(text):
+    """True if text has to be left to the interpreter, see REGEX_UNSAFE_TEXT"""
+    LoadRegexTables()
+    return REGEX_UNSAFE_TEXT.search(text) != None
+
+class RegexCompiler:
+    """
+    Lowers a ParserNode tree to match steps built on re. Each node becomes a
+    pattern that matches exactly what the node parses: ordered choice,
+    Optional and Many never give back what they matched, so they're wrapped
+    as atomic groups ((?=(...))(?P=...)) unless a lookahead does the same job.
+    Nodes named in Names get a capture group, which is only possible where
+    they can't repeat; Many and Sequence nodes around them become Python
+    loops over the inner patterns (ManyStep, SequenceStep).
+    """
+    def __init__(self, names):
+        self.Names = set(names)
+        self.Groups = {} # group -> (name, enclosing named groups)
+        self.Enclosing = []
+        self.Repeated = 0
+        self.Count = 0
+    def NewGroup(self):
+        self.Count += 1
+        return 'g' + str(self.Count)
+    def Atomic(self, pattern):
+        group = self.NewGroup()
+        return u'(?=(?P<' + group + u'>' + pattern + u'))(?P=' + group + u')'
+    def Whitespace(self):
+        if WHITESPACE_INCLUDES_NEWLINES: return ur'\s'
+        else: return ur'[^\S\n\r]'
+    def GraphemeSet(self, graphemes):
+        singles = sorted([g for g in set(graphemes) if len(g) == 1])
+        multis = sorted([g for g in set(graphemes) if len(g) > 1], key=len, reverse=True)
+        alternatives = [re.escape(g) for g in multis]
+        if len(singles) > 0: alternatives.append(CharClass(singles))
+        if len(alternatives) == 0: return u'(?!)'
+        return u'(?:' + u'|'.join(alternatives) + u')(?!' + COMBINING_CLASS + u')'
+    def Pattern(self, node):
+        """(pattern, simple) for node; simple patterns match one grapheme or one whitespace run, in at most one way"""
+        if node.Name in self.Names:
+            if self.Repeated > 0: raise NotRegularException("'" + node.Name + "' repeats under a ManyNode")
+            if isinstance(node, OptionalNode): raise NotRegularException("named OptionalNode")
+            group = self.NewGroup()
+            self.Groups[group] = (node.Name, list(self.Enclosing))
+            self.Enclosing.append(group)
+            pattern, simple = self.UnnamedPattern(node)
+            self.Enclosing.pop()
+            return u'(?P<' + group + u'>' + pattern + u')', simple
+        return self.UnnamedPattern(node)
+    def UnnamedPattern(self, node):
+        if isinstance(node, GraphemeNode):
+            return self.GraphemeSet(node.Graphemes), True
+        elif isinstance(node, PatternSetNode):
+            patterns = sorted(node.Trie.Patterns, key=len, reverse=True)
+            if all([len(p) == 1 for p in patterns]): return self.GraphemeSet([p[0] for p in patterns]), True
+            # longest first, so re's first alternative is the one PatternSetNode would take
+            return self.Atomic(u'|'.join([re.escape(u''.join(p)) + u'(?!' + COMBINING_CLASS + u')' for p in patterns])), False
+        elif isinstance(node, WhitespaceNode):
+            ws = self.Whitespace()
+            return ws + u'+(?!' + ws + u')', True
+        elif isinstance(node, EndNode):
+            return self.Pattern(node.WhitespaceAndEOL)[0] + ur'\Z', False
+        elif isinstance(node, ManyEndsWithSubsetNode):
+            raise NotRegularException("ManyEndsWithSubsetNode backtracks")
+        elif isinstance(node, OrNode):
+            if all([isinstance(n, GraphemeNode) and not(n.Name in self.Names) for n in node.Nodes]):
+                return self.GraphemeSet([g for n in node.Nodes for g in n.Graphemes]), True
+            return self.Atomic(u'|'.join([self.Pattern(n)[0] for n in node.Nodes])), False
+        elif isinstance(node, OptionalNode):
+            pattern, simple = self.Pattern(node.Node)
+            if simple: return u'(?:' + pattern + u'|(?!' + pattern + u'))', False
+            return self.Atomic(u'(?:' + pattern + u')?'), False
+        elif isinstance(node, ManyNode):
+            self.Repeated += 1
+            pattern, simple = self.Pattern(node.Node)
+            self.Repeated -= 1
+            if simple: return u'(?:' + pattern + u')+(?!' + pattern + u')', False
+            return self.Atomic(u'(?:' + pattern + u')+'), False
+        elif isinstance(node, SequenceNode):
+            if len(node.Nodes) == 0: raise NotRegularException("empty SequenceNode")
+            return u'(?:' + u''.join([self.Pattern(n)[0] for n in node.Nodes]) + u')', False
+        elif isinstance(node, SeparatedSequenceNode):
+            if not(node.StoreSep): raise NotRegularException("SeparatedSequenceNode drops its separators")
+            if len(node.Nodes) == 0: raise NotRegularException("empty SeparatedSequenceNode")
+            sep = self.Pattern(node.SepNode)[0]
+            parts = [sep] if node.InitialSep else []
+            for ii in range(len(node.Nodes)):
+                parts.append(self.Pattern(node.Nodes[ii])[0])
+                if node.FinalSep or ii != len(node.Nodes) - 1: parts.append(sep)
+            return u'(?:' + u''.join(parts) + u')', False
+        raise NotRegularException("no pattern for " + type(node).__name__)
+    def Step(self, node):
+        try:
+            return RegexStep(self.Regex(node), self.Groups)
+        except NotRegularException:
+            if isinstance(node, ManyNode) and not(node.Name in self.Names):
+                return ManyStep(self.Step(node.Node))
+            elif isinstance(node, SequenceNode) and len(node.Nodes) > 0 and not(node.Name in self.Names):
+                return SequenceStep([self.Step(n) for n in node.Nodes])
+            raise
+    def Regex(self, node):
+        groups = dict(self.Groups)
+        count = self.Count
+        try:
+            pattern = self.Pattern(node)[0]
+            return re.compile(pattern, re.UNICODE)
+        except (NotRegularException, AssertionError, OverflowError, RuntimeError, re.error) as e:
+            # re.compile fails on too many groups or too deep nesting
+            self.Groups, self.Count = groups, count
+            self.Enclosing, self.Repeated = [], 0
+            if isinstance(e, NotRegularException): raise
+            raise NotRegularException("re could not compile it: " + str(e))
+
+class RegexStep:
+    def __init__(self, regex, groups):
+        self.Regex = regex
+        # pattern order, so spans come out in text order with enclosing groups first
+        self.Groups = sorted([g for g in regex.groupindex.keys() if g in groups], key=regex.groupindex.get)
+    def Match(self, text, pos, spans):
+        m = self.Regex.match(text, pos)
+        if m == None: return None
+        for group in self.Groups:
+            start = m.start(group)
+            if start != -1: spans.append((start, m.end(group), group))
+        return m.end()
+
+class ManyStep:
+    """ManyNode.DoParse over a step"""
+    def __init__(self, step):
+        self.Step = step
+    def Match(self, text, pos, spans):
+        if pos >= len(text): return self.Step.Match(text, pos, spans)
+        count = 0
+        p = pos
+        while p < len(text):
+            mark = len(spans)
+            pending = self.Step.Match(text, p, spans)
+            if pending == None or (pending == p and count > 0):
+                del spans[mark:]
+                break
+            count += 1
+            p = pending
+        return p if count > 0 else None
+
+class SequenceStep:
+    def __init__(self, steps):
+        self.Steps = steps
+    def Match(self, text, pos, spans):
+        mark = len(spans)
+        p = pos
+        for step in self.Steps:
+            p = step.Match(text, p, spans)
+            if p == None:
+                del spans[mark:]
+                return None
+        return p
+
+COMPILE_TO_REGEX = True # CompiledParser uses re where the grammar allows, otherwise the interpreter
+
+class CompiledParser:
+    """
+    node.Parse(text)[1].ReplaceWith(d) for d keyed by names, through re
+    wherever the grammar allows it. Path is "regex" or "interpreter", and
+    Reason says what kept a grammar on the interpreter. Text the patterns
+    can't handle (see REGEX_UNSAFE_TEXT) always goes to the interpreter.
+    """
+    def __init__(self, node, names):
+        self.Node = node
+        self.Names = list(names)
+        self.Build()
+    def __repr__(self):
+        return "CompiledParser(" + str(self.Node) + ", " + str(self.Names) + ")"
+    def Build(self):
+        LoadRegexTables()
+        self.WhitespaceIncludesNewlines = WHITESPACE_INCLUDES_NEWLINES
+        compiler = RegexCompiler(self.Names)
+        try:
+            self.Step = compiler.Step(self.Node)
+            self.Groups = compiler.Groups
+            self.Path = "regex"
+            self.Reason = None
+        except NotRegularException as e:
+            self.Step = None
+            self.Path = "interpreter"
+            self.Reason = str(e)
+    @property
+    def Tag(self):
+        return self.Node.Tag
+    def Parse(self, s0):
+        return self.Node.Parse(s0)
+    def Replace(self, text, d):
+        """The replaced text, or None if the grammar doesn't parse text"""
+        if self.WhitespaceIncludesNewlines != WHITESPACE_INCLUDES_NEWLINES: self.Build()
+        if self.Step == None or not(COMPILE_TO_REGEX) or not(type(text) is unicode) or REGEX_UNSAFE_TEXT.search(text):
+            s1, res = self.Node.Parse(text)
+            if res == None: return None
+            return res.ReplaceWith(d)
+        spans = []
+        end = self.Step.Match(text, 0, spans)
+        if end == None: return None
+        out = []
+        p = 0
+        for (start, stop, group) in spans:
+            name, enclosing = self.Groups[group]
+            if not(name in d) or any([self.Groups[g][0] in d for g in enclosing]): continue
+            out.append(text[p:start])
+            out.append(Replacement(d[name], text[start:stop]))
+            p = stop
+        out.append(text[p:end])
+        return u''.join(out)
+
+# =================================================
+# =================== Profiling ===================
+# =================================================
+class NodeStats:
+    """What one grammar node did while profiling; Backtracks counts its sub-parses that failed"""
+    def __init__(self, node, tag):
+        self.Node = node
+        self.Tag = tag
+        self.Calls = 0
+        self.Successes = 0
+        self.Failures = 0
+        self.Consumed = 0
+        self.Time = 0.0
+        self.ChildTime = 0.0
+        self.Backtracks = 0
+    def SelfTime(self):
+        return self.Time - self.ChildTime
+
+class ParserProfiler:
+    def __init__(self):
+        self.Stats = {} # id(node) -> NodeStats
+        self.Stack = []
+    def StatsFor(self, node):
+        stats = self.Stats.get(id(node))
+        if stats == None:
+            # nodes below the top of a parse belong to the rule being parsed
+            tag = node.Tag if len(self.Stack) == 0 else self.Stack[-1].Tag
+            stats = self.Stats[id(node)] = NodeStats(node, tag)
+        return stats
+    def Record(self, node, parse, pos):
+        stats = self.StatsFor(node)
+        self.Stack.append(stats)
+        start = timer()
+        try:
+            end, res = parse()
+        finally:
+            self.Stack.pop()
+        elapsed = timer() - start
+        stats.Calls += 1
+        stats.Time += elapsed
+        if len(self.Stack) > 0: self.Stack[-1].ChildTime += elapsed
+        if res == None:
+            stats.Failures += 1
+            if len(self.Stack) > 0: self.Stack[-1].Backtracks += 1
+        else:
+            stats.Successes += 1
+            stats.Consumed += end - pos
+        return end, res
+    def Hot(self, top=None):
+        """NodeStats by time spent in the node itself, slowest first"""
+        stats = sorted(self.Stats.values(), key=lambda s: s.SelfTime(), reverse=True)
+        return stats if top == None else stats[0:top]
+    def Report(self, top=20, out=None):
+        if out == None: out = sys.stdout
+        out.write("%9s %9s %8s %8s %8s %8s %8s  %s\n" % ("self ms", "total ms", "calls", "ok", "failed", "backtrk", "chars", "node [rule]"))
+        for s in self.Hot(top):
+            node = repr(s.Node)
+            if len(node) > 50: node = node[0:47] + "..."
+            tag = u" [" + s.Tag + u"]" if s.Tag != None else u""
+            line = u"%9.2f %9.2f %8d %8d %8d %8d %8d  %s%s\n" % (s.SelfTime() * 1000, s.Time * 1000,
+                s.Calls, s.Successes, s.Failures, s.Backtracks, s.Consumed, node, tag)
+            out.write(line.encode("utf-8")) # rule tags are IPA, and out may be a pipe
+
+PROFILER = None # the active ParserProfiler, see EnableProfiling
+UNPROFILED_PARSE_AT = ParserNode.__dict__['ParseAt']
+UNPROFILED_REPLACE = CompiledParser.__dict__['Replace']
+
+def ProfiledParseAt(self, text, pos, limit, memo=None):
+    return PROFILER.Record(self, lambda: UNPROFILED_PARSE_AT(self, text, pos, limit, memo), pos)
+
+def ProfiledReplace(self, text, d):
+    # a compiled match shows up as the CompiledParser itself, with no nodes below it
+    end, res = PROFILER.Record(self, lambda: (len(text), UNPROFILED_REPLACE(self, text, d)), 0)
+    return res
+
+def EnableProfiling():
+    """
+    Start recording NodeStats for every node parse and CompiledParser.Replace.
+    Profiling swaps in instrumented methods, so it costs nothing while off.
+    """
+    global PROFILER
+    if PROFILER == None:
+        ParserNode.ParseAt = ProfiledParseAt
+        CompiledParser.Replace = ProfiledReplace
+    PROFILER = ParserProfiler()
+    return PROFILER
+
+def DisableProfiling():
+    """Put the plain methods back; returns the profiler that was active, for its Report"""
+    global PROFILER
+    profiler = PROFILER
+    ParserNode.ParseAt = UNPROFILED_PARSE_AT
+    CompiledParser.Replace = UNPROFILED_REPLACE
+    PROFILER = None
+    return profiler
+
 # =================================================
 # ================== Testing ======================
 # =================================================
@@ -606,6 +1490,61 @@ def CheckRepr(node):
         print "FAIL: str for", str(node)
 
 def DoTests():
+    errors = set()
+    RunTests({'GraphemeSplit': GraphemeSplit, 'PopGrapheme': PopGrapheme, 'errors': errors},
+        [ ([], 'GraphemeSplit(u"")')
+         ,([u"a", u"m̥", u"b"], u'GraphemeSplit(u"am̥b")')
+         ,([u"̥"], u'GraphemeSplit(u"̥")')
+         ,([], u'GraphemeSplit(u"̥a", errorsTo=errors)')
+         ,(set([u"̥a"]), 'errors')
+         ,((u"ŋ̊", u"k"), u'PopGrapheme(u"ŋ̊k")')
+        ])
+    errors = set()
+    batch = GraphemeSplitMany([u"am̥b", u"", u"̥a", u"̥", u"ŋ̊k"], errorsTo=errors)
+    RunTests({'batch': batch, 'errors': errors},
+        [ ([[u"a", u"m̥", u"b"], [], [], [u"̥"], [u"ŋ̊", u"k"]], 'list(batch)')
+         ,([u"a", u"m̥", u"b", u"̥", u"ŋ̊", u"k"], 'batch.AllGraphemes()')
+         ,(set([u"̥a"]), 'errors')
+        ])
+
+    RunTests({'NaturalClass': NaturalClass},
+        [ (frozenset([u"s", u"z"]), 'NaturalClass("alveolar", "fricative")')
+         ,(frozenset([u"c"]), 'NaturalClass("palatal", "plosive", voiced=False)')
+         ,(True, u'u"ʁ" in NaturalClass(manner="fricative") and u"ʁ" in NaturalClass(manner="approximant")')
+         ,(frozenset([u"i", u"y"]), 'NaturalClass(height="high/close", backness=["front", "near-front"])')
+         ,(True, 'NaturalClass(voiced=True, manner="fricative") is NaturalClass(manner="fricative", voicing="voiced")')
+        ])
+
+    RunTests({'FeatureShift': FeatureShift, 'ManyNode': ManyNode, 'AlphaNode': AlphaNode, 'CompiledParser': CompiledParser},
+        [ (u"ɲ̥", u'FeatureShift("palatal", "nasal")[u"c"]')
+         ,(u"ɲ̥", u'FeatureShift("palatal", "nasal")[u"s"]')
+         ,(u"z", u'FeatureShift("voiced")[u"s"]')
+         ,(False, u'u"a" in FeatureShift("voiced")')
+         ,(True, 'FeatureShift("nasal", "palatal") is FeatureShift("palatal", "nasal")')
+         ,(u"zab", u'ManyNode(AlphaNode(name="x")).Parse(u"sab")[1].ReplaceWith({"x": FeatureShift("voiced")})')
+         ,(u"zab", u'CompiledParser(ManyNode(AlphaNode(name="x")), ["x"]).Replace(u"sab", {"x": FeatureShift("voiced")})')
+        ])
+
+    trie = GraphemeTrie([u"he", u"she", u"his", u"hers", u"m̥a"])
+    RunTests({'trie': trie},
+        [ (4, 'trie.LongestAt(u"ushers", 1, 6)')
+         ,(6, 'trie.LongestAt(u"ushers", 2, 6)')
+         ,(None, 'trie.LongestAt(u"ushers", 1, 3)')
+         ,(3, u'trie.LongestAt(u"m̥a", 0, 3)')
+         ,(None, u'trie.LongestAt(u"m̥̥a", 0, 4)')
+        ])
+
+    p = PatternSetNode([u"s", u"se", u"sei", u"m̥"])
+    RunTests({'p': p, 'PatternSetNode': PatternSetNode, 'CompiledParser': CompiledParser, 'ManyNode': ManyNode, 'OrNode': OrNode, 'AlphaNode': AlphaNode},
+        [ (("", True), 'p.Recognize(u"se")')
+         ,(("", True), 'p.Recognize(u"sei")')
+         ,(("a", True), 'p.Recognize(u"sea")')
+         ,(("m", False), 'p.Recognize(u"m")')
+         ,(u"x", 'CompiledParser(PatternSetNode([u"s", u"se"], name="x"), ["x"]).Replace(u"se", {"x": u"x"})')
+         ,(u"xm̥", u'CompiledParser(ManyNode(OrNode([PatternSetNode([u"s", u"sm"], name="x"), AlphaNode()])), ["x"]).Replace(u"sm̥", {"x": u"x"})')
+        ])
+    CheckRepr(p)
+
     p = GraphemeNode(['a','b'])
     RunTests({'p': p}, 
         [ (("", True), 'p.Recognize(u"a")')
@@ -950,6 +1889,73 @@ def DoTests():
         ])
     CheckRepr(p)
 
+    p = OrNode([SequenceNode([ManyNode(AlphaNode()), HashNode()]), SequenceNode([ManyNode(AlphaNode()), OptionalWhitespaceNode()])])
+    RunTests({'p': p, 'PackratParse': PackratParse},
+        [ (u"ab ", 'PackratParse(p, u"ab ")[1].Text')
+         ,(u"ab#", 'PackratParse(p, u"ab#")[1].Text')
+         ,([[u"a", u"b"], u" "], 'PackratParse(p, u"ab c")[1].GetParsedResult()')
+         ,(p.Parse(u"ab c")[0], 'PackratParse(p, u"ab c")[0]')
+        ])
+
+    p = SequenceNode([ManyNode(AlphaNode()), EndNode()])
+    RunTests({'p': p},
+        [ (3, 'p.ParseAt(u" ab cd", 1, 3)[0]')
+         ,(u"ab", 'p.ParseAt(u" ab cd", 1, 3)[1].Text')
+         ,(4, 'p.ParseAt(u" ab cd", 1, 4)[0]')
+         ,((1, None), 'p.ParseAt(u" ab cd", 1, 5)')
+        ])
+
+    # results are independent of the grammar and of each other
+    p = ManyNode(OrNode([GraphemeNode(u"a", name="x"), AlphaNode()]))
+    r1 = p.Parse(u"ab")[1]
+    r2 = p.Parse(u"bab")[1]
+    RunTests({'p': p, 'r1': r1, 'r2': r2, 'ParseResult': ParseResult},
+        [ (u"Xb", 'r1.ReplaceWith({"x": u"X"})')
+         ,(u"bXb", 'r2.ReplaceWith({"x": u"X"})')
+         ,([u"a"], '[n.Text for n in r2.FindAll("x")]')
+         ,(True, 'isinstance(r1.Children[0], ParseResult)')
+         ,(False, 'hasattr(r1, "__dict__")')
+         ,(False, 'hasattr(p, "ParsedNodes")')
+        ])
+
+    p = ManyNode(OrNode([GraphemeNode(u"s", name="x"), AlphaNode(), WhitespaceOrPunctuationNode()]))
+    q = ManyNode(OrNode([ManyEndsWithSubsetNode(AlphaNode(), GraphemeNode(u"s", name="x"), 1), WhitespaceNode()]))
+    RunTests({'CompiledParser': CompiledParser, 'p': p, 'q': q},
+        [ ("regex", 'CompiledParser(p, ["x"]).Path')
+         ,(u"at a.t", 'CompiledParser(p, ["x"]).Replace(u"as a.s", {"x": u"t"})')
+         ,(u"am̥ a", u'CompiledParser(p, ["x"]).Replace(u"am̥ a", {"x": u"t"})')
+         ,(None, 'CompiledParser(p, ["x"]).Replace(u"", {"x": u"t"})')
+         ,(u"ʃa", u'CompiledParser(p, ["x"]).Replace(u"ʃa,s", {"x": u"t"})')
+         ,("interpreter", 'CompiledParser(q, ["x"]).Path')
+         ,(u"at at", 'CompiledParser(q, ["x"]).Replace(u"as as", {"x": u"t"})')
+        ])
+
+    p = OrNode([GraphemeNode(u"ab", name="x"), OptionalNode(GraphemeNode(u"c")), ManyNode(AlphaNode())])
+    RunTests({'p': p},
+        [ (None, 'p.FirstChars()')
+         ,(3, 'len(p.Dispatch[u"a"])')
+         ,(None, 'p.Dispatch.get(u".")')
+         ,(1, 'len(p.Anywhere)')
+         ,(frozenset([u"a", u"b"]), 'p.Nodes[0].FirstChars()')
+         ,(u"x", 'p.Parse(u"b")[1].Children[0].Name')
+         ,(u"", 'p.Parse(u".")[1].Text')
+         ,(u"", 'p.Parse(u"")[1].Text')
+        ])
+
+    p = OrNode([SequenceNode([GraphemeNode(u"b"), GraphemeNode(u"a")]), GraphemeNode(u"b")])
+    p.Tag = "rule"
+    profiler = EnableProfiling()
+    p.Parse(u"b")
+    DisableProfiling()
+    RunTests({'p': p, 'profiler': profiler, 'ParserNode': ParserNode, 'UNPROFILED_PARSE_AT': UNPROFILED_PARSE_AT},
+        [ (5, 'len(profiler.Stats)')
+         ,((1, 1, 0, 1), '(lambda s: (s.Calls, s.Successes, s.Failures, s.Backtracks))(profiler.Stats[id(p)])')
+         ,("rule", 'profiler.Stats[id(p.Nodes[0])].Tag')
+         ,(1, 'profiler.Stats[id(p.Nodes[0])].Failures')
+         ,(1, 'profiler.Hot()[0].Calls')
+         ,(UNPROFILED_PARSE_AT, 'ParserNode.__dict__["ParseAt"]')
+        ])
+
     p = GroupNode(GraphemeNode('['), ManyNode(AlphaNode()), GraphemeNode(']'))
     #print p
     RunTests({'p': p},
@@ -978,8 +1984,7 @@ def showchar(line):
             # check for diacritics
             comb = "m" + g[1]
             print "Comb is:",comb
-            gsd = GraphemeSplit(DIACRITICS)
-            v = comb in gsd
+            v = comb in DIACRITIC_GRAPHEMES
             print v
 
         if g in ConsonantData:
@@ -48,12 +48,10 @@ def AddToAlphabetIfNeeded(existingAlphabet, extractedAlphabet):
     return result
 
 def ExtractAlphabet(vocab, corpus):
-    graphemes = set()
     suspectWords = set()
-    for word in vocab:
-        [graphemes.add(g) for g in ipaParse.GraphemeSplit(word, errorsTo=suspectWords) if g in ipaParse.ALL_ALPHA]
-    for line in corpus:
-        [graphemes.add(g) for g in ipaParse.GraphemeSplit(line[0], errorsTo=suspectWords) if g in ipaParse.ALL_ALPHA]
+    texts = list(vocab) + [line[0] for line in corpus]
+    batch = ipaParse.GraphemeSplitMany(texts, errorsTo=suspectWords)
+    graphemes = set(batch.AllGraphemes()) & ipaParse.ALL_ALPHA_SET
     return (list(graphemes), suspectWords)
 
 def GetDefaultAttributes():
@@ -85,6 +83,8 @@ class Language:
         return self.Graphemes
     def SetAlphabet(self, alphabet):
         self.Graphemes = list(alphabet)
+    def SetCorpus(self, corpus):
+        self.Corpus = list(corpus)
     def Save(self, path):
         import os
         target = os.path.join(path, self.Name)
@@ -93,18 +93,36 @@ class Language:
         if len(self.Corpus) > 0: DumpCorpusToFile(self.Corpus, target + CORPUS_FILE_EXT)
 
     @staticmethod
-    def FromSoundChange(languageIn, newName, soundChangeFunc):
-        vocab = {}
+    def FromSoundChange(languageIn, newName, sc, workers=1, chunkSize=soundChange.PARALLEL_CHUNK_SIZE, corpusByWord=True):
+        """A new Language with sc (a soundChange.SoundChange) applied to the vocabulary, corpus and alphabet
+        workers other than 1 shares the words out to that many processes (None for one per CPU), see SoundChange.ApplyParallel
+        corpusByWord sound changes each distinct corpus word once instead of each line, see SoundChange.ApplyToLines"""
+        entries = []
         for (w,entryList) in languageIn.Vocabulary.items():
             if (len(w) == 0):
                 print "empty line in input lang vocab"
                 continue
-            word = soundChangeFunc(w)[-1]
+            entries.append((w,entryList))
+        lines = [s[0] for s in languageIn.Corpus]
+        pool = sc.StartPool(workers) if workers != 1 else None # one pool for the whole derivation
+        try:
+            if corpusByWord:
+                texts = [w for (w,entryList) in entries] + list(languageIn.Graphemes)
+                changed = sc.ApplyBatch(texts, workers, chunkSize, pool) + sc.ApplyToLines(lines, workers, chunkSize, pool)
+            else:
+                texts = [w for (w,entryList) in entries] + list(languageIn.Graphemes) + lines
+                changed = sc.ApplyBatch(texts, workers, chunkSize, pool)
+        finally:
+            if pool != None: pool.terminate()
+        vocab = {}
+        for ((w,entryList), word) in zip(entries, changed):
             if not(word in vocab): vocab[word] = []
             vocab[word].extend(entryList)
-        corpus = [[soundChangeFunc(s[0])[-1]]+s[1:] for s in languageIn.Corpus]
+        changed = changed[len(entries):]
+        letters = changed[0:len(languageIn.Graphemes)]
+        corpus = [[word]+s[1:] for (s, word) in zip(languageIn.Corpus, changed[len(letters):])]
         extractedAlphabet, suspectWords = ExtractAlphabet(vocab, corpus)
-        alphabet = AddToAlphabetIfNeeded([soundChangeFunc(letter)[-1] for letter in languageIn.Graphemes], extractedAlphabet)
+        alphabet = AddToAlphabetIfNeeded(letters, extractedAlphabet)
         return Language(newName, vocab, alphabet, suspectWords=languageIn.SuspectWords.union(suspectWords), corpus=corpus)
 
 class LanguageFamily:
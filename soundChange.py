@@ -4,6 +4,10 @@
 #  Understands multi-codepoint graphemes
 
 from ipaParse import *
+import collections
+import ipaParse
+import json
+from timeit import default_timer as timer
 WHITESPACE_INCLUDES_NEWLINES = False # turn off newlines as wspace in ipaParse
 STOP_ON_EXCEPTION = False
 
@@ -59,7 +63,7 @@ TESTS = [
          ,u'abte abte')]]
 # todo to parse this:
 # (done) 1. parse [ ] -- or terms
-# >>> here >>> 2. parse { } -- ref terms
+# (done) 2. parse { } -- ref terms
 
 
 #################################################
@@ -68,8 +72,40 @@ TESTS = [
         ,(u'aɟa aɟ ɟa ɟ', u'aɲa aɲ ɲa ɲ')]
       ]
 # todo to parse this:
-# 1. find individual sound mappings,
+# (done) 1. find individual sound mappings,
 #  s.t. voiced palatal plosive -> voiced palatal nasal
+    ,[u'a > /{nasal}_' # feature values work in conditions too
+      , [(u'ma ba na mam', u'm ba n mm')]
+      ]
+]
+
+# Each way of running a cascade checked against Apply, see RunEngineTests. Rows are
+#  (rules, words, statements, extras): each statement must give Apply(w)[-1]
+#  for every w in words, and each extra is an (expected, statement) pair, both
+#  evaluated with sc (a SoundChange of rules) and words.
+ENGINE_TESTS = [
+    ([u'b > p /', u's > /_#'], [u'bas', u'sab', u'bas', u'', u'sab']
+     , ['sc.ApplyMany(words)', 'sc.ApplyBatch(words)', '[sc.Transduce(w) for w in words]']
+     , [(True, '[sc.StagesFromHistory(w, h) for (w, h) in zip(words, sc.ApplyMany(words, history=True))] == [sc.Apply(w) for w in words]')
+       ,(3, 'len(sc.FinalMemo)')])
+    ,([u'b > p /', u's > /_#'], [u'bas', u'sab', u'bas', u'', u'sab', u'abba', u'sabs']
+     , ['sc.ApplyParallel(words, workers=2, chunkSize=2)']
+     , [])
+    ,([u'b > p /', u's > /_#', u'pa > ba /', u'[ei] > a /_{vowel}'], [u'bas', u'sab', u'pie', u'bas', u'', u'se', u'a b', u'ba.', u'abs?']
+     , ['IndexedForms(sc, words)', '[sc.ApplyFinal(w) for w in words]', '[sc.StagesFromHistory(w, sc.History(w))[-1] if w != u"" else w for w in words]']
+     , [([4, 6, 7, 8], 'sorted(WordIndex(words).Candidates(sc.Compiled[2].RequiredKeys()))')])
+    ,([u'b > p /', u's > /_#', u'a > /'], [u'bas sab. bas', u'', u'sa  a', u'ab, bas', u' bas\tas ', u'a a']
+     , ['sc.ApplyToLines(words)', 'sc.ApplyToLines(words, workers=2)']
+     , [([True, False, True, False, True, True], '[split != None for split in LineWords(words)[0]]')])
+    ,([u'b > p /', u's > /_#', u'z > s /'], [u'bas', u'sab', u'pie', u'', u'bas']
+     , ['ApplyWithStats(sc, words)[0]']
+     , [([(u'b > p /', 4, 3), (u's > /_#', 4, 2), (u'z > s /', 4, 0)], '[(s.RuleLine, s.Attempted, s.Changed) for s in ApplyWithStats(sc, words)[1].Rules]')
+       ,([u'z > s /'], '[s.RuleLine for s in ApplyWithStats(sc, words)[1].Dead()]')
+       ,(4, 'json.loads(ApplyWithStats(sc, words)[1].ToJson())[0]["attempted"]')
+       ,(None, 'sc.Stats')])
+    ,([u'b > p /', u'd > t /', u'p > f /', u's > /_#', u'k > /', u'a > e /', u'[sz] > /'], [u'bad dap', u'kak', u'k k', u'k a', u'dabs ', u'', u'sz']
+     , ['[sc.ApplyFinal(w) for w in words]', '[sc.Transduce(w) for w in words]', 'sc.ApplyMany(words)']
+     , [([u'b > p / ; d > t /', u'p > f /', u's > /_#', u'k > / ; a > e / ; [sz] > /'], '[rule.RuleLine for rule in sc.Fused()]')])
 ]
 
 #################################################
@@ -84,30 +120,40 @@ AFTER_NAMED_CONDITION = "afterNamed"
 BEFORE_NAMED_CONDITION = "beforeNamed"
 BETWEEN_NAMED_CONDITION = "betweenNamed"
 SPECIAL_NAME = "specialName"
+FROM_CLASS_NODE_NAME = "fromClass"
+TO_CLASS_NODE_NAME = "toClass"
+
+def ClassNode(name):
+    """{ } around a special name, or around feature values such as {alveolar fricative}"""
+    return GroupNode(GraphemeNode('{'), ManyNode(OrNode([AlphaNode(), GraphemeNode([u'_', u'/']), WhitespaceNode()]), name=name), GraphemeNode('}'))
+
+def ClassGraphemes(name, specialNames=None):
+    """The graphemes {name} stands for: specialNames[name], or every grapheme having the feature values in name"""
+    name = name.strip()
+    if specialNames != None and name in specialNames: return specialNames[name]
+    return NaturalClass(*name.split())
 
 def ParseSoundChangeRule(ruleString, specialNames=None):
+    # {} holds one of specialNames or feature values, so the named conditions are always on offer
     conditions=[
           SequenceNode([UnderscoreNode(), HashNode()], name=END_OF_WORD_CONDITION)
         , SequenceNode([HashNode(), UnderscoreNode()], name=START_OF_WORD_CONDITION)
+        # {}_{} needs to go first, because it is a superset of the other two,
+        #  the others will get recognized but not eat enough of the condition
+        , SequenceNode([
+            ClassNode(SPECIAL_NAME)
+            , UnderscoreNode()
+            , ClassNode(SPECIAL_NAME)]
+            , name=BETWEEN_NAMED_CONDITION)
+        , SequenceNode([
+            ClassNode(SPECIAL_NAME)
+            , UnderscoreNode()]
+            , name=AFTER_NAMED_CONDITION)
+        , SequenceNode([
+            UnderscoreNode()
+            , ClassNode(SPECIAL_NAME)]
+            , name=BEFORE_NAMED_CONDITION)
     ]
-    if specialNames != None:
-        conditions.extend([
-            # {}_{} needs to go first, because it is a superset of the other two,
-            #  the others will get recognized but not eat enough of the condition
-            SequenceNode([
-                GroupNode(GraphemeNode('{'),ManyNode(AlphaNode(),name=SPECIAL_NAME),GraphemeNode('}'))
-                , UnderscoreNode()
-                , GroupNode(GraphemeNode('{'),ManyNode(AlphaNode(),name=SPECIAL_NAME),GraphemeNode('}'))]
-                , name=BETWEEN_NAMED_CONDITION)
-            , SequenceNode([
-                GroupNode(GraphemeNode('{'),ManyNode(AlphaNode(),name=SPECIAL_NAME),GraphemeNode('}'))
-                , UnderscoreNode()]
-                , name=AFTER_NAMED_CONDITION)
-            , SequenceNode([
-                UnderscoreNode()
-                , GroupNode(GraphemeNode('{'),ManyNode(AlphaNode(),name=SPECIAL_NAME),GraphemeNode('}'))]
-                , name=BEFORE_NAMED_CONDITION)
-        ])
 
     return SeparatedSequenceNode(
                 separatorNode = OptionalWhitespaceNode()
@@ -118,9 +164,13 @@ def ParseSoundChangeRule(ruleString, specialNames=None):
                     OrNode([
                         ManyNode(AlphaNode(), name=FROM_NODE_NAME)
                        ,GroupNode(GraphemeNode('['),ManyNode(AlphaNode(name=FROM_NODE_NAME)),GraphemeNode(']')) # inside [ ], each grapheme is an option
+                       ,ClassNode(FROM_CLASS_NODE_NAME) # every grapheme of the class is an option
                     ])
                     , GraphemeNode('>')
-                    , OptionalNode(ManyNode(AlphaNode(), name=TO_NODE_NAME))
+                    , OptionalNode(OrNode([
+                        ManyNode(AlphaNode(), name=TO_NODE_NAME)
+                       ,ClassNode(TO_CLASS_NODE_NAME) # each from grapheme moves to its counterpart in the class
+                    ]))
                     , GraphemeNode('/')
                     , SelectNameOneOfOrNoneNode(name=CONDITION_NODE_NAME, namedOptionNodes=conditions)
                     , EndNode()
@@ -128,14 +178,13 @@ def ParseSoundChangeRule(ruleString, specialNames=None):
         ).Parse(ruleString)
 
 def CreateParserFromSoundChange(fromPatterns, condition, conditionArgs, specialNames=None):
-    fromNodes = []
-    for fromPattern in fromPatterns:
-        L = GraphemeSplit(fromPattern)
-        if len(L) == 1: fromNode = GraphemeNode(fromPattern, name=FROM_NODE_NAME)
+    if len(fromPatterns) > 1:
+        # one trie walk rather than an option per pattern; the longest pattern wins
+        fromNode = PatternSetNode(fromPatterns, name=FROM_NODE_NAME)
+    else:
+        L = GraphemeSplit(fromPatterns[0])
+        if len(L) == 1: fromNode = GraphemeNode(fromPatterns[0], name=FROM_NODE_NAME)
         else: fromNode = SequenceNode([GraphemeNode(g) for g in L], name=FROM_NODE_NAME)
-        fromNodes.append(fromNode)
-    if len(fromNodes) == 1: fromNode = fromNodes[0]
-    else: fromNode = OrNode(fromNodes)
 
     if condition == None:
         return ManyNode(OrNode([fromNode,OrNode([AlphaNode(),WhitespaceOrPunctuationNode()])]))
@@ -174,9 +223,9 @@ def CreateParserFromSoundChange(fromPatterns, condition, conditionArgs, specialN
         return ManyNode(
             OrNode([
                 SequenceNode([
-                    GraphemeNode(specialNames[conditionArgs[0]])
+                    GraphemeNode(sorted(ClassGraphemes(conditionArgs[0], specialNames)))
                     , fromNode
-                    , GraphemeNode(specialNames[conditionArgs[1]])])
+                    , GraphemeNode(sorted(ClassGraphemes(conditionArgs[1], specialNames)))])
                 , AlphaNode()
                 , OrNode([EndNode(), WhitespaceOrPunctuationNode()])
             ])
@@ -184,7 +233,7 @@ def CreateParserFromSoundChange(fromPatterns, condition, conditionArgs, specialN
     elif condition == AFTER_NAMED_CONDITION:
         return ManyNode(
             OrNode([
-                SequenceNode([GraphemeNode(specialNames[conditionArgs[0]]), fromNode])
+                SequenceNode([GraphemeNode(sorted(ClassGraphemes(conditionArgs[0], specialNames))), fromNode])
                 , AlphaNode()
                 , OrNode([EndNode(), WhitespaceOrPunctuationNode()])
             ])
@@ -192,7 +241,7 @@ def CreateParserFromSoundChange(fromPatterns, condition, conditionArgs, specialN
     elif condition == BEFORE_NAMED_CONDITION:
         return ManyNode(
             OrNode([
-                SequenceNode([fromNode, GraphemeNode(specialNames[conditionArgs[0]])])
+                SequenceNode([fromNode, GraphemeNode(sorted(ClassGraphemes(conditionArgs[0], specialNames)))])
                 , AlphaNode()
                 , OrNode([EndNode(), WhitespaceOrPunctuationNode()])
             ])
@@ -203,18 +252,49 @@ SPECIAL_NAME = "specialName"
 def DoReplacement(replacerPair, text):
     parser, toPattern = replacerPair
     if text == None or text.strip() == '': return '' # don't bother trying to replace on empty
-    s1, res = parser.Parse(text)
-    if res == None:
+    replaced = parser.Replace(text, {FROM_NODE_NAME: toPattern})
+    if replaced == None:
         print "Failed to parse:", text
         print "Was trying to replace with:", toPattern
         print "tag:", parser.Tag
         raise Exception("failed to parse")
-    return res.ReplaceWith({FROM_NODE_NAME: toPattern})
+    return replaced
 
 def CreateReplacerPair(res, specialNames=None, ruleLine=None):
-    fromPatterns = [n.Text for n in res.FindAll(FROM_NODE_NAME)]
+    fromPatterns, toPattern, condition, conditionArgs = ReadSoundChangeRule(res, specialNames)
+    p = CreateParserFromSoundChange(fromPatterns, condition, conditionArgs, specialNames)
+    p.Tag = ruleLine
+    return CompiledParser(p, [FROM_NODE_NAME]), toPattern
+
+#################################################
+### Transducers: a whole cascade in one pass
+#################################################
+# Each rule is compiled to a deterministic grapheme transducer that makes
+#  the same choices as its parser; the cascade is run as their composition,
+#  with every composed (state, grapheme) step remembered, so a word costs one
+#  dict lookup per grapheme. Words the transducers can't vouch for (the
+#  parser would stop early, or complain) go through DoReplacement instead.
+
+class UncompilableRuleException(Exception): pass
+
+WAIT = "wait" # need more input before deciding
+DEAD = None # the parser would stop short of the end here
+WORD_START = 0
+IN_WORD = 1
+TRANSDUCER_MEMO_LIMIT = 200000 # composed steps remembered per cascade before starting over
+
+def ReadSoundChangeRule(res, specialNames=None):
+    """(fromPatterns, toPattern, condition, conditionArgs) from a parsed rule"""
+    fromClass = res.FindAll(FROM_CLASS_NODE_NAME)
+    if len(fromClass) > 0:
+        fromPatterns = sorted(ClassGraphemes(fromClass[0].Text, specialNames))
+    else:
+        fromPatterns = [n.Text for n in res.FindAll(FROM_NODE_NAME)]
     toSet = res.FindAll(TO_NODE_NAME)
-    if len(toSet) == 0:
+    toClass = res.FindAll(TO_CLASS_NODE_NAME)
+    if len(toClass) > 0:
+        toPattern = FeatureShift(*toClass[0].Text.split()) # a dict, see ipaParse.Replacement
+    elif len(toSet) == 0:
         toPattern = ""
     else:
         toPattern = toSet[0].Text
@@ -227,10 +307,628 @@ def CreateReplacerPair(res, specialNames=None, ruleLine=None):
         if condition in (AFTER_NAMED_CONDITION, BEFORE_NAMED_CONDITION, BETWEEN_NAMED_CONDITION):
             specials = conditionNodeSet[0].FindAll(SPECIAL_NAME)
             conditionArgs = [special.Text for special in specials]
+    return fromPatterns, toPattern, condition, conditionArgs
 
-    p = CreateParserFromSoundChange(fromPatterns, condition, conditionArgs, specialNames)
-    p.Tag = ruleLine
-    return p, toPattern
+class RuleTransducer:
+    """
+    One rule as a transducer over graphemes. States are tuples
+    (solid, held, mode, pending, sawWord): held is leading whitespace kept
+    back until something solid turns up (DoReplacement turns blank text into
+    ''), pending is input not yet decided on, or for end-of-word rules the
+    last few graphemes of the current word.
+    """
+    def __init__(self, fromPatterns, toPattern, condition, conditionArgs, specialNames):
+        # longest first, as PatternSetNode takes the longest pattern
+        self.Froms = sorted([tuple(GraphemeSplit(p)) for p in fromPatterns], key=len, reverse=True)
+        self.To = dict([(p, tuple(SplitGraphemes(unicode(Replacement(toPattern, u''.join(p)))))) for p in self.Froms])
+        self.Condition = condition
+        self.Alpha = AlphaNode().GraphemeSet
+        self.Passable = WHITESPACE_CHARS | frozenset([u'.'])
+        if len(self.Froms) == 0 or any([len(p) == 0 or not(set(p) <= self.Alpha) for p in self.Froms]):
+            raise UncompilableRuleException("from patterns must be graphemes of AlphaNode")
+        if any([RegexUnsafe(u''.join(to)) for to in self.To.values()]):
+            raise UncompilableRuleException("to pattern would not split the same way in context")
+        if condition == None: sequence = [None]
+        elif condition == AFTER_NAMED_CONDITION: sequence = [conditionArgs[0], None]
+        elif condition == BEFORE_NAMED_CONDITION: sequence = [None, conditionArgs[0]]
+        elif condition == BETWEEN_NAMED_CONDITION: sequence = [conditionArgs[0], None, conditionArgs[1]]
+        elif condition in (START_OF_WORD_CONDITION, END_OF_WORD_CONDITION): sequence = []
+        else: raise UncompilableRuleException("unknown condition " + str(condition))
+        # the rule's sequence alternative: None for the from patterns, or a set of graphemes
+        self.Sequence = [frozenset(ClassGraphemes(arg, specialNames)) if arg != None else None for arg in sequence]
+        for graphemes in self.Sequence:
+            if graphemes != None and len(graphemes & self.Passable) > 0:
+                raise UncompilableRuleException("special name includes whitespace or '.'")
+        self.Longest = max([len(p) for p in self.Froms])
+    def Start(self):
+        return (False, (), WORD_START, (), False)
+    def Step(self, state, g):
+        """(state, output graphemes) after g, or DEAD"""
+        solid, held, mode, pending, sawWord = state
+        if not(solid):
+            if g.isspace(): return (False, held + (g,), mode, pending, sawWord), ()
+            out = []
+            state = (True, (), mode, pending, sawWord)
+            for h in held + (g,):
+                step = self.Step(state, h)
+                if step == DEAD: return DEAD
+                state, more = step
+                out.extend(more)
+            return state, tuple(out)
+        mode, pending, sawWord, out = self.Resolve(mode, pending + (g,), sawWord, False)
+        if mode == DEAD: return DEAD
+        return (True, (), mode, pending, sawWord), out
+    def Finish(self, state):
+        """output graphemes at the end of the text, or DEAD"""
+        solid, held, mode, pending, sawWord = state
+        if not(solid): return ()
+        mode, pending, sawWord, out = self.Resolve(mode, pending, sawWord, True)
+        if mode == DEAD: return DEAD
+        if self.Condition in (START_OF_WORD_CONDITION, END_OF_WORD_CONDITION) and not(sawWord):
+            return DEAD # nothing but whitespace and '.': the word loop fails outright
+        return out
+    def MatchFrom(self, pending, ii, final, limit=None):
+        """the first from pattern matching pending[ii:limit], None, or WAIT if that needs more input"""
+        if limit == None: limit = len(pending)
+        for p in self.Froms:
+            have = limit - ii
+            if have >= len(p):
+                if pending[ii:ii+len(p)] == p: return p
+            elif not(final) and pending[ii:limit] == p[0:have]:
+                return WAIT
+        return None
+    def MatchSequence(self, pending, final):
+        """(consumed, output) for the rule's sequence at pending[0], None, or WAIT"""
+        ii = 0
+        out = []
+        for graphemes in self.Sequence:
+            if graphemes == None:
+                p = self.MatchFrom(pending, ii, final)
+                if p == None or p == WAIT: return p
+                out.extend(self.To[p])
+                ii += len(p)
+            else:
+                if ii >= len(pending): return None if final else WAIT
+                if not(pending[ii] in graphemes): return None
+                out.append(pending[ii])
+                ii += 1
+        return ii, out
+    def Resolve(self, mode, pending, sawWord, final):
+        """decide what can be decided about pending: (mode, pending, sawWord, output), mode DEAD on failure"""
+        if self.Condition == END_OF_WORD_CONDITION: return self.ResolveEndOfWord(mode, pending, sawWord, final)
+        out = []
+        while len(pending) > 0:
+            g = pending[0]
+            if self.Condition == START_OF_WORD_CONDITION:
+                if mode == WORD_START and not(g in self.Passable):
+                    p = self.MatchFrom(pending, 0, final)
+                    if p == WAIT: break
+                    if p != None:
+                        out.extend(self.To[p])
+                        pending = pending[len(p):]
+                        mode, sawWord = IN_WORD, True
+                        continue
+                    if not(g in self.Alpha): return DEAD, (), sawWord, ()
+                    mode, sawWord = IN_WORD, True
+                elif mode == IN_WORD and g in self.Passable: mode = WORD_START
+                elif not(g in self.Alpha or g in self.Passable): return DEAD, (), sawWord, ()
+            else:
+                match = self.MatchSequence(pending, final)
+                if match == WAIT: break
+                if match != None:
+                    out.extend(match[1])
+                    pending = pending[match[0]:]
+                    continue
+                if not(g in self.Alpha or g in self.Passable): return DEAD, (), sawWord, ()
+            out.append(g)
+            pending = pending[1:]
+        return mode, pending, sawWord, tuple(out)
+    def ResolveEndOfWord(self, mode, pending, sawWord, final):
+        # pending is the current word's last few graphemes, plus the new one
+        out = []
+        if len(pending) > 0 and not(final):
+            g = pending[-1]
+            word = pending[0:-1]
+            if g in self.Alpha:
+                if len(pending) > self.Longest:
+                    out.append(pending[0])
+                    pending = pending[1:]
+                return IN_WORD, pending, True, tuple(out)
+            if not(g in self.Passable): return DEAD, (), sawWord, ()
+            out.extend(self.EndOfWord(word))
+            out.append(g)
+            return WORD_START, (), sawWord, tuple(out)
+        out.extend(self.EndOfWord(pending))
+        return WORD_START, (), sawWord, tuple(out)
+    def EndOfWord(self, word):
+        """word's last graphemes, after ManyEndsWithSubsetNode's right to left search for a from pattern"""
+        for cut in range(len(word) - 1, -1, -1):
+            p = self.MatchFrom(word, cut, True, len(word))
+            if p != None:
+                if cut + len(p) == len(word): return word[0:cut] + self.To[p]
+                return word
+        return word
+
+class CascadeTransducer:
+    """The composition of consecutive RuleTransducers, applied in one pass"""
+    def __init__(self, transducers):
+        self.Transducers = transducers
+        self.Start = tuple([t.Start() for t in transducers])
+        self.Steps = {}
+        self.Finishes = {}
+    def Step(self, state, g):
+        states = list(state)
+        out = (g,)
+        for ii in range(len(self.Transducers)):
+            t = self.Transducers[ii]
+            s = states[ii]
+            passed = []
+            for h in out:
+                step = t.Step(s, h)
+                if step == DEAD: return DEAD
+                s, more = step
+                passed.extend(more)
+            states[ii] = s
+            out = passed
+        return tuple(states), tuple(out)
+    def Finish(self, state):
+        states = list(state)
+        out = ()
+        for ii in range(len(self.Transducers)):
+            t = self.Transducers[ii]
+            s = states[ii]
+            passed = []
+            for h in out:
+                step = t.Step(s, h)
+                if step == DEAD: return DEAD
+                s, more = step
+                passed.extend(more)
+            more = t.Finish(s)
+            if more == DEAD: return DEAD
+            out = tuple(passed) + more
+        return out
+    def Apply(self, text):
+        """the cascade's output for text, or None where DoReplacement has to decide"""
+        # the same text CompiledParser leaves to the interpreter splits into
+        #  graphemes differently than the parsers take it apart
+        if not(type(text) is unicode) or RegexUnsafe(text): return None
+        if len(self.Steps) > TRANSDUCER_MEMO_LIMIT:
+            self.Steps = {}
+            self.Finishes = {}
+        steps = self.Steps
+        state = self.Start
+        out = []
+        for g in GraphemeSplit(text):
+            step = steps.get((state, g), WAIT)
+            if step == WAIT:
+                step = steps[(state, g)] = self.Step(state, g)
+            if step == DEAD: return None
+            state, more = step
+            out.extend(more)
+        more = self.Finishes.get(state, WAIT)
+        if more == WAIT:
+            more = self.Finishes[state] = self.Finish(state)
+        if more == DEAD: return None
+        out.extend(more)
+        return u''.join(out)
+
+#################################################
+### Grapheme index: only try a rule on words it could change
+#################################################
+# A word made only of AlphaNode graphemes parses right through every rule,
+#  so a rule leaves it alone unless one of its from patterns is in it. The
+#  index keeps such words by the graphemes and grapheme bigrams they contain;
+#  anything else (whitespace, punctuation, unknown graphemes) is Unindexed
+#  and tried against every rule, as DoReplacement may still change it.
+
+def IndexKey(pattern):
+    """The posting a word needs to hold pattern: its first grapheme bigram, or its grapheme"""
+    return tuple(pattern[0:2])
+
+def RequiredKeys(fromPatterns):
+    """WordIndex keys at least one of which a word must have for the rule to fire, or None if any word might"""
+    alpha = AlphaNode().GraphemeSet
+    patterns = [GraphemeSplit(unicode(p)) for p in fromPatterns]
+    if len(patterns) == 0 or any([len(p) == 0 or not(set(p) <= alpha) for p in patterns]): return None
+    return frozenset([IndexKey(p) for p in patterns])
+
+class WordIndex:
+    """Current forms of a list of words, with the word IDs holding each grapheme and grapheme bigram"""
+    def __init__(self, words):
+        self.Alpha = AlphaNode().GraphemeSet
+        self.Forms = list(words)
+        self.Postings = collections.defaultdict(set)
+        self.Keys = [None] * len(self.Forms)
+        self.Unindexed = set()
+        errors = set()
+        for (ii, graphemes) in enumerate(GraphemeSplitMany([unicode(w) for w in self.Forms], errorsTo=errors)):
+            self.Add(ii, graphemes if not(self.Forms[ii] in errors) else None)
+    def WordKeys(self, graphemes):
+        if graphemes == None or len(graphemes) == 0 or not(set(graphemes) <= self.Alpha): return None
+        keys = set([(g,) for g in graphemes])
+        keys.update([tuple(graphemes[ii:ii+2]) for ii in range(len(graphemes) - 1)])
+        return keys
+    def Add(self, ii, graphemes):
+        keys = self.Keys[ii] = self.WordKeys(graphemes)
+        if keys == None:
+            self.Unindexed.add(ii)
+        else:
+            for key in keys: self.Postings[key].add(ii)
+    def Update(self, ii, form):
+        """Make form word ii's current form, moving it between postings"""
+        if self.Keys[ii] == None:
+            self.Unindexed.discard(ii)
+        else:
+            for key in self.Keys[ii]: self.Postings[key].discard(ii)
+        self.Forms[ii] = form
+        try:
+            graphemes = GraphemeSplit(unicode(form))
+        except Exception:
+            graphemes = None
+        self.Add(ii, graphemes)
+    def Candidates(self, keys):
+        """IDs, in order, of the words a rule with these RequiredKeys might change"""
+        if keys == None: return range(len(self.Forms))
+        ids = set(self.Unindexed)
+        for key in keys: ids.update(self.Postings.get(key, ()))
+        return sorted(ids)
+    def ApplyRule(self, rule):
+        """Run rule, a CompiledRule, on the current form of each word it might change; returns how many words it ran on"""
+        applied = 0
+        for ii in self.Candidates(rule.RequiredKeys()):
+            form = self.Forms[ii]
+            if form == "": continue
+            changed = rule.Apply(form)
+            applied += 1
+            if changed != form: self.Update(ii, changed)
+        return applied
+
+#################################################
+### Stage checkpoints: rerun a cascade from the first edited rule
+#################################################
+
+def SameRule(a, b):
+    return a is b or (a.RuleLine == b.RuleLine and a.SpecialNames == b.SpecialNames)
+
+class StageCheckpoints:
+    """
+    Every word's form after each rule of a cascade. Update with an edited
+    cascade keeps the stages before the first changed rule, runs new or
+    edited rules on the words that might change (see WordIndex), and runs
+    the unchanged rules after them only on words whose input to them moved.
+    """
+    def __init__(self, words):
+        self.Words = list(collections.OrderedDict.fromkeys(words))
+        self.Rules = [] # CompiledRule for each stage after the first
+        self.Stages = [self.Words] # Stages[k] is every word after k rules
+        self.Recomputed = 0 # rule applications made by the last Update
+    def __repr__(self):
+        return "StageCheckpoints({0} words, {1} stages, {2} replacements last update)".format(len(self.Words), len(self.Rules), self.Recomputed)
+    def Update(self, sc):
+        """Bring the stages in line with sc, a SoundChange; returns the final forms"""
+        old, new = self.Rules, sc.Compiled
+        prefix = 0
+        while prefix < min(len(old), len(new)) and SameRule(old[prefix], new[prefix]): prefix += 1
+        suffix = 0
+        while suffix < min(len(old), len(new)) - prefix and SameRule(old[-1-suffix], new[-1-suffix]): suffix += 1
+        stages = self.Stages[0:prefix+1]
+        recomputed = 0
+        middle = new[prefix:len(new)-suffix]
+        if len(middle) > 0:
+            index = WordIndex(stages[-1])
+            for rule in middle:
+                recomputed += index.ApplyRule(rule)
+                stages.append(list(index.Forms))
+        if suffix > 0:
+            # the unchanged tail: only words whose input differs from last time need the rule again
+            offset = len(old) - len(new)
+            current, oldIn = stages[-1], self.Stages[len(new) - suffix + offset]
+            dirty = [ii for ii in xrange(len(current)) if current[ii] is not oldIn[ii] and current[ii] != oldIn[ii]]
+            for jj in range(len(new) - suffix, len(new)):
+                oldOut = self.Stages[jj + offset + 1]
+                out = list(oldOut)
+                stillDirty = []
+                for ii in dirty:
+                    form = current[ii]
+                    if form != "":
+                        form = new[jj].Apply(form)
+                        recomputed += 1
+                    out[ii] = form
+                    if form != oldOut[ii]: stillDirty.append(ii)
+                stages.append(out)
+                current, dirty = out, stillDirty
+        self.Rules, self.Stages, self.Recomputed = list(new), stages, recomputed
+        return self.Stages[-1]
+    def Final(self, words):
+        """The last stage's form of each of words, which must be among Words"""
+        results = dict(zip(self.Words, self.Stages[-1]))
+        return [results[word] for word in words]
+
+#################################################
+### Skipping rules that can't match
+#################################################
+PLAIN_GRAPHEMES = None # AlphaNode graphemes and '.', built by PlainGraphemes
+
+def PlainGraphemes(text):
+    """
+    (graphemes, set of them) if every rule parses text right through and
+    gives it back unless a from pattern is in it: it has an AlphaNode
+    grapheme and nothing but those, whitespace and '.'. Otherwise None.
+    """
+    global PLAIN_GRAPHEMES
+    if PLAIN_GRAPHEMES == None: PLAIN_GRAPHEMES = AlphaNode().GraphemeSet | frozenset([u'.'])
+    if not(type(text) is unicode): return None
+    try:
+        graphemes = GraphemeSplit(text)
+    except Exception:
+        return None
+    graphemeSet = set(graphemes)
+    others = graphemeSet - PLAIN_GRAPHEMES
+    for g in others:
+        if not(g.isspace()) or (not(ipaParse.WHITESPACE_INCLUDES_NEWLINES) and (g == u'\n' or g == u'\r')): return None
+    if len(graphemeSet - others - frozenset([u'.'])) == 0: return None
+    return graphemes, graphemeSet
+
+#################################################
+### Corpus lines, word by word
+#################################################
+# Rules only see within a word: from patterns, to patterns and special
+#  names have no whitespace or '.', which is all that separates words. So a
+#  plain line (see PlainGraphemes) can be sound changed one word at a time
+#  and put back together, unless every word ends up empty: the whole line
+#  went blank along the way, which DoReplacement treats differently.
+
+def SplitLine(line):
+    """The words of line with the whitespace and '.' between them, or None if the line has to be sound changed whole"""
+    plain = PlainGraphemes(line)
+    if plain == None: return None
+    pieces = []
+    wordFlags = []
+    for g in plain[0]:
+        isWord = not(g == u'.' or g.isspace())
+        if len(pieces) > 0 and wordFlags[-1] == isWord:
+            pieces[-1].append(g)
+        else:
+            pieces.append([g])
+            wordFlags.append(isWord)
+    return [(u''.join(piece), isWord) for (piece, isWord) in zip(pieces, wordFlags)]
+
+def LineWords(lines):
+    """(splits, words): SplitLine for each line, and the texts to sound change, a word or a whole line each"""
+    splits = [SplitLine(line) for line in lines]
+    words = []
+    for (line, split) in zip(lines, splits):
+        if split == None: words.append(line)
+        else: words.extend([piece for (piece, isWord) in split if isWord])
+    return splits, words
+
+def JoinLine(split, changed):
+    """The line split came from, with each word replaced through the changed dict, or None if it has to be done whole"""
+    pieces = [changed[piece] if isWord else piece for (piece, isWord) in split]
+    if all([changed[piece] == "" for (piece, isWord) in split if isWord]): return None
+    return u''.join(pieces)
+
+#################################################
+### Rule fusion: one pass for a run of independent rules
+#################################################
+# An unconditioned rule whose from patterns are single graphemes rewrites
+#  each grapheme on its own, so a run of them is one grapheme-to-text map,
+#  as long as no rule in the run can produce a grapheme a later one rewrites.
+#  The fused rule parses with the same grammar over the union of the from
+#  graphemes, so it accepts, drops and complains about exactly the same text.
+#  The one difference is a word going blank partway through the run (see
+#  DoReplacement), so a blank result is worked out again rule by rule.
+
+def FusableMap(rule):
+    """{from grapheme: replacement} if rule can join a FusedRule, else None"""
+    fromPatterns, toPattern, condition, conditionArgs = ReadSoundChangeRule(rule.Parsed, rule.SpecialNames)
+    if condition != None: return None
+    alpha = AlphaNode().GraphemeSet
+    result = {}
+    for p in fromPatterns:
+        if GraphemeSplit(p) != [p] or not(p in alpha): return None
+        to = unicode(Replacement(toPattern, p))
+        errors = set()
+        if not(set(GraphemeSplit(to, errors)) <= alpha) or len(errors) > 0: return None
+        result[p] = to
+    return result
+
+class FusedRule:
+    """A run of rules FuseRules found independent, as one DoReplacement; looks like a CompiledRule to RunPasses"""
+    def __init__(self, rules, maps, specialNames=None):
+        self.Rules = rules
+        self.RuleLine = u" ; ".join([rule.RuleLine for rule in rules])
+        self.Map = {}
+        for m in maps:
+            for (g, to) in m.items():
+                if not(g in self.Map): self.Map[g] = to # an earlier rule has already rewritten g
+        p = CreateParserFromSoundChange(sorted(self.Map), None, None, specialNames)
+        p.Tag = self.RuleLine
+        self.ReplacerPair = (CompiledParser(p, [FROM_NODE_NAME]), self.Map)
+        self.Firsts = frozenset(self.Map)
+    def Untouched(self, graphemeSet):
+        return self.Firsts.isdisjoint(graphemeSet)
+    def Apply(self, text):
+        result = DoReplacement(self.ReplacerPair, text)
+        if result.strip() != '': return result
+        for rule in self.Rules: text = rule.Apply(text)
+        return text
+
+def FuseRules(compiled, specialNames=None):
+    """The passes for a list of CompiledRules: each a CompiledRule, or a FusedRule for a run of two or more"""
+    passes = []
+    run, maps, produced = [], [], set()
+    def Flush():
+        if len(run) == 1: passes.append(run[0])
+        elif len(run) > 1: passes.append(FusedRule(run, maps, specialNames))
+    for rule in compiled:
+        m = FusableMap(rule)
+        if m == None or produced.intersection(m):
+            Flush()
+            run, maps, produced = [], [], set()
+        if m == None:
+            passes.append(rule)
+            continue
+        run.append(rule)
+        maps.append(m)
+        for to in m.values(): produced.update(GraphemeSplit(to))
+    Flush()
+    return passes
+
+#################################################
+### Rule stats: what each rule of a cascade did
+#################################################
+
+class RuleStat:
+    """What one rule did while stats were on; Skipped counts words it was ruled out for without a parse"""
+    def __init__(self, ruleLine):
+        self.RuleLine = ruleLine
+        self.Attempted = 0
+        self.Changed = 0
+        self.Skipped = 0
+        self.Time = 0.0
+        self.WorstTime = 0.0
+        self.WorstInput = None
+    def Record(self, text, changed, elapsed):
+        self.Attempted += 1
+        if changed != text: self.Changed += 1
+        self.Time += elapsed
+        if self.WorstInput == None or elapsed > self.WorstTime:
+            self.WorstTime = elapsed
+            self.WorstInput = text
+    def AsDict(self):
+        return {"rule": self.RuleLine, "attempted": self.Attempted, "changed": self.Changed, "skipped": self.Skipped,
+            "seconds": self.Time, "worst_seconds": self.WorstTime, "worst_input": self.WorstInput}
+
+class RuleStats:
+    """A RuleStat per rule of a SoundChange, in rule order, see SoundChange.EnableStats"""
+    SORT_KEYS = {"time": lambda s: s.Time, "worst": lambda s: s.WorstTime, "attempted": lambda s: s.Attempted,
+        "changed": lambda s: s.Changed, "skipped": lambda s: s.Skipped}
+    def __init__(self, ruleLines):
+        self.Rules = [RuleStat(ruleLine) for ruleLine in ruleLines]
+    def Sorted(self, key="time"):
+        """RuleStats by key (one of SORT_KEYS), largest first"""
+        return sorted(self.Rules, key=self.SORT_KEYS[key], reverse=True)
+    def Dead(self):
+        """Rules that never changed a word: dead, at least for the words seen so far"""
+        return [s for s in self.Rules if s.Changed == 0]
+    def Report(self, top=None, key="time", out=None):
+        if out == None: out = sys.stdout
+        stats = self.Sorted(key)
+        if top != None: stats = stats[0:top]
+        out.write("%9s %9s %8s %8s %8s  %-30s %s\n" % ("total ms", "worst ms", "tried", "changed", "skipped", "rule", "worst input"))
+        for s in stats:
+            worst = s.WorstInput if s.WorstInput != None else u""
+            if len(worst) > 30: worst = worst[0:27] + u"..."
+            line = u"%9.2f %9.2f %8d %8d %8d  %-30s %s\n" % (s.Time * 1000, s.WorstTime * 1000,
+                s.Attempted, s.Changed, s.Skipped, s.RuleLine, worst)
+            out.write(line.encode("utf-8")) # rules and words are IPA, and out may be a pipe
+        dead = self.Dead()
+        if len(dead) > 0: out.write("%d rules never changed a word\n" % len(dead))
+    def ToJson(self, path=None, key="time"):
+        """The stats as JSON, sorted by key; written to path too if given"""
+        text = json.dumps([s.AsDict() for s in self.Sorted(key)], indent=1, sort_keys=True, ensure_ascii=False)
+        if path != None:
+            import codecs
+            outFile = codecs.open(path, "w", encoding="utf-8")
+            outFile.write(unicode(text))
+            outFile.close()
+        return text
+
+#################################################
+### Compiled rule cache
+#################################################
+RULE_CACHE_SIZE = 2000 # compiled rules kept by RULE_CACHE, least recently used dropped first
+
+def SpecialNamesFingerprint(specialNames):
+    """Stands in for specialNames in RuleCache keys; equal dicts give equal fingerprints"""
+    import hashlib
+    if specialNames == None: return None
+    items = sorted([(name, list(graphemes)) for (name, graphemes) in specialNames.items()])
+    return hashlib.sha1(repr(items)).hexdigest()
+
+class CompiledRule:
+    """Everything built from one rule line: its parse, its replacer pair and, once asked for, its RuleTransducer"""
+    def __init__(self, ruleLine, specialNames=None):
+        s1, res = ParseSoundChangeRule(ruleLine, specialNames)
+        self.RuleLine = ruleLine
+        self.SpecialNames = specialNames
+        self.ReplacerPair = CreateReplacerPair(res, specialNames, ruleLine)
+        self.Parsed = res
+        self.TransducerBuilt = False
+        self.RequiredKeysResult = False
+        self.Cascade = False # this rule alone as a CascadeTransducer, or None, built by Apply
+        self.Firsts = None # first grapheme of each from pattern, built by Untouched
+    def RequiredKeys(self):
+        """see RequiredKeys; None if the rule might change any word"""
+        if self.RequiredKeysResult == False:
+            fromPatterns, toPattern, condition, conditionArgs = ReadSoundChangeRule(self.Parsed, self.SpecialNames)
+            self.RequiredKeysResult = RequiredKeys(fromPatterns)
+        return self.RequiredKeysResult
+    def Transducer(self):
+        """(RuleTransducer, None), or (None, why not)"""
+        if not(self.TransducerBuilt):
+            try:
+                fromPatterns, toPattern, condition, conditionArgs = ReadSoundChangeRule(self.Parsed, self.SpecialNames)
+                self.TransducerResult = (RuleTransducer(fromPatterns, toPattern, condition, conditionArgs, self.SpecialNames), None)
+            except UncompilableRuleException as e:
+                self.TransducerResult = (None, str(e))
+            self.TransducerBuilt = True
+        return self.TransducerResult
+    def Untouched(self, graphemeSet):
+        """True if DoReplacement would hand back a text with these graphemes (see PlainGraphemes): no from pattern can start in it"""
+        if self.Firsts == None:
+            fromPatterns, toPattern, condition, conditionArgs = ReadSoundChangeRule(self.Parsed, self.SpecialNames)
+            self.Firsts = frozenset([GraphemeSplit(unicode(p))[0] for p in fromPatterns])
+        return self.Firsts.isdisjoint(graphemeSet)
+    def Apply(self, text):
+        """DoReplacement(ReplacerPair, text), through the rule's transducer where it can vouch for the result"""
+        if self.Cascade == False:
+            t, reason = self.Transducer()
+            self.Cascade = CascadeTransducer([t]) if t != None else None
+        if self.Cascade != None and ipaParse.WHITESPACE_INCLUDES_NEWLINES:
+            result = self.Cascade.Apply(text)
+            if result != None: return result
+        return DoReplacement(self.ReplacerPair, text)
+
+class RuleCache:
+    """Process-wide CompiledRules keyed by (rule line, special names fingerprint), least recently used dropped past Limit"""
+    def __init__(self, limit):
+        self.Limit = limit
+        self.Entries = collections.OrderedDict()
+        self.Hits = 0
+        self.Misses = 0
+    def __repr__(self):
+        return "RuleCache({0} of {1} entries, {2} hits, {3} misses)".format(len(self.Entries), self.Limit, self.Hits, self.Misses)
+    def Get(self, ruleLine, specialNames=None, fingerprint=False):
+        if fingerprint == False: fingerprint = SpecialNamesFingerprint(specialNames)
+        key = (ruleLine, fingerprint)
+        rule = self.Entries.pop(key, None)
+        if rule == None:
+            self.Misses += 1
+            rule = CompiledRule(ruleLine, specialNames)
+        else:
+            self.Hits += 1
+        self.Entries[key] = rule
+        if len(self.Entries) > self.Limit: self.Entries.popitem(last=False)
+        return rule
+    def Clear(self):
+        self.Entries.clear()
+        self.Hits = 0
+        self.Misses = 0
+
+RULE_CACHE = RuleCache(RULE_CACHE_SIZE)
+
+APPLY_MEMO_SIZE = 100000 # words each SoundChange remembers for ApplyMany, oldest dropped first
+PARALLEL_CHUNK_SIZE = 500 # words handed to a worker at a time by ApplyParallel
+
+WORKER_SOUND_CHANGE = None # the SoundChange each ApplyParallel worker process rebuilt
+
+def StartWorker(ruleList, specialNames):
+    global WORKER_SOUND_CHANGE
+    WORKER_SOUND_CHANGE = SoundChange(ruleList, specialNames)
+def ApplyChunk(words):
+    return WORKER_SOUND_CHANGE.ApplyMany(words)
 
 def CombineListOfDicts(L):
     items = []
@@ -243,23 +941,184 @@ def CombineListOfLists(L):
 
 class SoundChange:
     def __init__(self, ruleList, specialNames=None):
-        parsedRules = [(ParseSoundChangeRule(ruleLine, specialNames), ruleLine) for ruleLine in ruleList]
-        replacerPairs = [(CreateReplacerPair(pscr[1], specialNames, ruleLine),ruleLine) for (pscr,ruleLine) in parsedRules if pscr != None]
+        fingerprint = SpecialNamesFingerprint(specialNames)
+        self.Compiled = [RULE_CACHE.Get(ruleLine, specialNames, fingerprint) for ruleLine in ruleList]
         # this needs to be ordered, because order of application matters
         #  if we want to change this to another datastructure, self.Rules
         #  should probably have a list
-        self.Rules = [(rp,ruleLine) for (rp,ruleLine) in replacerPairs if rp != None]
+        self.Rules = [(rule.ReplacerPair,rule.RuleLine) for rule in self.Compiled]
         self.SpecialNames = specialNames
+        self.Segments = None # built by Transduce, along with TransducerPaths
+        self.TransducerPaths = None
+        self.FinalMemo = collections.OrderedDict() # word -> Transduce(word), for ApplyMany
+        self.HistoryMemo = collections.OrderedDict() # word -> History(word)
+        self.Stats = None # the RuleStats being recorded, see EnableStats
+        self.Passes = None # built by Fused
+    def EnableStats(self):
+        """Start recording a RuleStat per rule; every Apply method then goes rule by rule, and ApplyParallel runs serially
+        words ApplyMany already has in its memos aren't run again, so aren't counted"""
+        self.Stats = RuleStats(self.OrigRules())
+        return self.Stats
+    def DisableStats(self):
+        """Stop recording; returns the RuleStats that were being kept, for Report or ToJson"""
+        stats = self.Stats
+        self.Stats = None
+        return stats
+    def RunPasses(self, text, passes, stats=None, skip=True):
+        """
+        History(text) over passes, CompiledRules or FusedRules, leaving out
+        each pass that can't change text (see PlainGraphemes) unless not skip.
+        With stats, a RuleStats with a RuleStat per pass, each pass is timed.
+        """
+        deltas = []
+        if text == "": return deltas
+        plain = PlainGraphemes(text) if skip else None
+        for (ii, rule) in enumerate(passes):
+            stat = stats.Rules[ii] if stats != None else None
+            if plain != None and rule.Untouched(plain[1]):
+                if stat != None: stat.Skipped += 1
+                continue
+            if stat != None: start = timer()
+            changed = rule.Apply(text)
+            if stat != None: stat.Record(text, changed, timer() - start)
+            if changed != text:
+                deltas.append((ii, changed))
+                text = changed
+                if skip: plain = PlainGraphemes(text)
+        return deltas
     def Apply(self, text):
         if text == "": return "" # don't do anything to empty strings
+        if self.Stats != None: return self.StagesFromHistory(text, self.RunPasses(text, self.Compiled, self.Stats, skip=False))
         results = [text]
         for (rp,ruleLine) in self.Rules:
             results.append(DoReplacement(rp, results[-1]))
         return results
+    def ApplyFinal(self, text):
+        """Apply(text)[-1], keeping only the current form, with runs of independent rules fused into one pass (see Fused)"""
+        if text == "": return text
+        if self.Stats != None: deltas = self.RunPasses(text, self.Compiled, self.Stats) # stats are kept per rule
+        else: deltas = self.RunPasses(text, self.Fused())
+        return deltas[-1][1] if len(deltas) > 0 else text
+    def History(self, text):
+        """(rule index, new form) for each rule that changed text; Apply(text) without the unchanged stages"""
+        return self.RunPasses(text, self.Compiled, self.Stats)
+    def Fused(self):
+        """The rules as passes, with runs of independent rules fused into one, see FuseRules"""
+        if self.Passes == None: self.Passes = FuseRules(self.Compiled, self.SpecialNames)
+        return self.Passes
+    def FusionReport(self):
+        """How many passes Fused() saves, and which rules went into each fused pass"""
+        passes = self.Fused()
+        lines = ["%d rules in %d passes, %d passes eliminated" % (len(self.Compiled), len(passes), len(self.Compiled) - len(passes))]
+        for rule in passes:
+            if isinstance(rule, FusedRule): lines.append(u"  fused: " + rule.RuleLine)
+        return u"\n".join(lines)
+    def StagesFromHistory(self, text, deltas):
+        """Apply(text), rebuilt from History(text)"""
+        if text == "": return ""
+        results = [text]
+        for (ii, changed) in deltas:
+            results.extend([results[-1]] * (ii - len(results) + 1))
+            results.append(changed)
+        results.extend([results[-1]] * (len(self.Rules) + 1 - len(results)))
+        return results
+    def Transduce(self, text):
+        """Apply(text)[-1], running each stretch of compilable rules as one CascadeTransducer pass, and the rest as Fused passes"""
+        if text == "": return text
+        if self.Stats != None: return self.ApplyFinal(text)
+        if self.Segments == None: self.BuildTransducers()
+        for (cascade, passes) in self.Segments:
+            result = None
+            if cascade != None and ipaParse.WHITESPACE_INCLUDES_NEWLINES: result = cascade.Apply(text)
+            if result == None:
+                deltas = self.RunPasses(text, passes)
+                if len(deltas) > 0: text = deltas[-1][1]
+            else:
+                text = result
+        return text
+    def ApplyMany(self, words, history=False):
+        """[Transduce(w) for w in words], or [History(w) ...] with history, working out each distinct word once"""
+        memo = self.HistoryMemo if history else self.FinalMemo
+        results = {}
+        for word in words:
+            if word in results: continue
+            result = memo.get(word)
+            if result == None:
+                result = self.History(word) if history else self.Transduce(word)
+                memo[word] = result
+                if len(memo) > APPLY_MEMO_SIZE: memo.popitem(last=False)
+            results[word] = result
+        return [results[word] for word in words]
+    def ApplyBatch(self, words, workers=1, chunkSize=PARALLEL_CHUNK_SIZE, pool=None):
+        """ApplyMany(words), or ApplyParallel when given a pool or workers other than 1"""
+        if workers == 1 and pool == None: return self.ApplyMany(words)
+        return self.ApplyParallel(words, workers, chunkSize, pool)
+    def ApplyToLines(self, lines, workers=1, chunkSize=PARALLEL_CHUNK_SIZE, pool=None):
+        """ApplyMany(lines) for corpus lines, sound changing each distinct word once rather than each line (see SplitLine)"""
+        ownPool = pool == None and workers != 1
+        if ownPool: pool = self.StartPool(workers)
+        try:
+            splits, words = LineWords(lines)
+            changed = dict(zip(words, self.ApplyBatch(words, workers, chunkSize, pool)))
+            results = [JoinLine(split, changed) if split != None else changed[line] for (line, split) in zip(lines, splits)]
+            whole = [line for (line, result) in zip(lines, results) if result == None]
+            if len(whole) > 0:
+                changed = dict(zip(whole, self.ApplyBatch(whole, workers, chunkSize, pool)))
+                results = [result if result != None else changed[line] for (line, result) in zip(lines, results)]
+        finally:
+            if ownPool: pool.terminate()
+        return results
+    def StartPool(self, workers=None):
+        """A process pool whose workers each rebuild this SoundChange, to hand to ApplyParallel; terminate it when done"""
+        import multiprocessing
+        return multiprocessing.Pool(workers, StartWorker, (self.OrigRules(), self.SpecialNames))
+    def ApplyParallel(self, words, workers=None, chunkSize=PARALLEL_CHUNK_SIZE, pool=None):
+        """ApplyMany(words), with the distinct words not yet in the memo shared out to a pool of worker processes
+        pool is one from StartPool, left running; without it a pool of workers (None for every CPU) is started and stopped"""
+        if self.Stats != None: return self.ApplyMany(words) # the workers' stats would be lost
+        memo = self.FinalMemo
+        todo = list(collections.OrderedDict.fromkeys([word for word in words if not(word in memo)]))
+        if len(todo) > 0:
+            chunks = [todo[ii:ii+chunkSize] for ii in range(0, len(todo), chunkSize)]
+            ownPool = pool == None
+            if ownPool: pool = self.StartPool(workers)
+            try:
+                done = pool.map(ApplyChunk, chunks, 1)
+            finally:
+                if ownPool: pool.terminate()
+            results = dict(zip(todo, CombineListOfLists(done)))
+        else:
+            results = {}
+        for word in words:
+            if not(word in results): results[word] = memo[word]
+        for word in todo:
+            memo[word] = results[word]
+            if len(memo) > APPLY_MEMO_SIZE: memo.popitem(last=False)
+        return [results[word] for word in words]
+    def BuildTransducers(self):
+        """Segments: (CascadeTransducer or None, Fused passes of its rules) for each run of rules that do or don't compile"""
+        segments = []
+        paths = []
+        transducers, rules = [], []
+        def Flush():
+            segments.append((CascadeTransducer(transducers) if len(transducers) > 0 else None, FuseRules(rules, self.SpecialNames)))
+        for rule in self.Compiled:
+            t, reason = rule.Transducer()
+            paths.append((rule.RuleLine, "transducer" if t != None else "parser", reason))
+            if len(rules) > 0 and (t == None) != (len(transducers) == 0):
+                Flush()
+                transducers, rules = [], []
+            if t != None: transducers.append(t)
+            rules.append(rule)
+        if len(rules) > 0: Flush()
+        self.Segments, self.TransducerPaths = segments, paths
     def __repr__(self):
         return "SoundChange({0}, {1})".format(self.OrigRules(), self.SpecialNames)
     def OrigRules(self):
         return [ruleLine for (rp,ruleLine) in self.Rules]
+    def ParserPaths(self):
+        """(rule, "regex" or "interpreter", reason) for each rule, see ipaParse.CompiledParser"""
+        return [(ruleLine, rp[0].Path, rp[0].Reason) for (rp,ruleLine) in self.Rules]
     def Save(self, name):
         import codecs
         outFile = codecs.open(name, "w", encoding="utf-8")
@@ -282,6 +1141,32 @@ def GetSoundChanges(full_path):
         soundChanges.append(sc)
     return soundChanges
 
+def FinalForms(sc, words):
+    """Apply(w)[-1] for each of words, the reference for ENGINE_TESTS"""
+    return [sc.Apply(w)[-1] if w != u'' else u'' for w in words]
+
+def IndexedForms(sc, words):
+    """The final forms of words after running each rule of sc over a WordIndex of them"""
+    index = WordIndex(words)
+    for rule in sc.Compiled: index.ApplyRule(rule)
+    return index.Forms
+
+def ApplyWithStats(sc, words):
+    """(final forms of words, the RuleStats recorded working them out rule by rule with Apply)"""
+    stats = sc.EnableStats()
+    try:
+        return [sc.Apply(w)[-1] if w != u'' else u'' for w in words], stats
+    finally:
+        sc.DisableStats()
+
+def RunEngineTests(specialNames):
+    for (rules, words, statements, extras) in ENGINE_TESTS:
+        sc = SoundChange(rules, specialNames)
+        env = {'sc': sc, 'words': words, 'WordIndex': WordIndex, 'LineWords': LineWords, 'IndexedForms': IndexedForms, 'ApplyWithStats': ApplyWithStats, 'json': json}
+        expected = FinalForms(sc, words)
+        if RunTests(env, [(expected, statement) for statement in statements] + extras):
+            print u" ; ".join(rules), ": SUCCESS"
+
 if __name__ == '__main__':
     specialNames={"vowel":["a","e","i","o","u"]} # these vowels just for testing, get full list from ipaParse
     for test in TESTS:
@@ -291,12 +1176,16 @@ if __name__ == '__main__':
             print rule, ": DID NOT PARSE"
             continue
         rp = CreateReplacerPair(res, specialNames=specialNames)
+        sc = SoundChange([rule], specialNames)
         for entry in L:
             word,expected = entry
             try:
                 actual = DoReplacement(rp, word)
+                transduced = sc.Transduce(word)
                 if (actual != expected):
                     print rule, ": expected=", expected, "actual=", actual
+                elif (transduced != expected):
+                    print rule, ": expected=", expected, "transduced=", transduced
                 else:
                     print rule, ": SUCCESS"
             except Exception as e:
@@ -305,3 +1194,24 @@ if __name__ == '__main__':
                 else:
                     print rule, entry, ": EXCEPTION", e
 
+    RULE_CACHE.Clear()
+    SoundChange([TESTS[0][0]], specialNames)
+    SoundChange([TESTS[0][0]], dict(specialNames))
+    if (RULE_CACHE.Hits, RULE_CACHE.Misses) != (1, 1):
+        print "rule cache : expected 1 hit and 1 miss,", RULE_CACHE
+    else:
+        print "rule cache : SUCCESS"
+
+    RunEngineTests(specialNames)
+
+    words = [u'bas', u'sab', u'pie', u'', u'se', u'a b', u'ba.', u'sebi']
+    checkpoints = StageCheckpoints(words)
+    for rules in [[u'b > p /', u's > /_#'], [u'b > p /', u'e > i /', u's > /_#'], [u'b > p /', u'e > a /', u's > /_#'], [u'e > a /', u's > /_#'], [u'e > a /', u's > /_#']]:
+        sc = SoundChange(rules, specialNames)
+        checkpoints.Update(sc)
+        if checkpoints.Final(words) != sc.ApplyMany(words) or checkpoints.Stages != [list(stage) for stage in zip(*[sc.Apply(w) if w != u'' else [w] * (len(rules) + 1) for w in checkpoints.Words])]:
+            print "StageCheckpoints : expected", sc.ApplyMany(words), "got", checkpoints.Final(words), "after", rules
+            break
+    else:
+        if checkpoints.Recomputed != 0: print "StageCheckpoints : expected nothing to redo for the same rules,", checkpoints
+        else: print "StageCheckpoints : SUCCESS"